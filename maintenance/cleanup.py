@@ -2,7 +2,7 @@ import os
 import argparse
 import shutil
 import logging
-from shared.pipeline_utils import redis_client, notify_all
+from shared.pipeline_utils import get_files_by_status, notify_all
 
 # Logging config
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -33,7 +33,7 @@ SUFFIX_MAP = {
     "metadata": [".mp3.json", "_cover.jpg"],
     "queue": [".mp3"],
     "stems": [""],  # directories named after song
-    "output": ["_karaoke.mp3"],
+    "output": ["_preview_karaoke.mp3", "_karaoke.mp3"],
 }
 
 
@@ -42,19 +42,16 @@ def list_cleanable_files():
     Return a list of (stage, path_to_delete) for completed files no longer in active Redis states.
     """
     clean_targets = []
-    organized_files = redis_client.keys("file:*")
-    organized = set()
-    for k in organized_files:
-        data = redis_client.hgetall(k)
-        if data.get("status") == "organized":
-            base = k.replace("file:", "")
-            namebase = os.path.splitext(base)[0]
-            organized.add(namebase)
+    organized = {
+        os.path.splitext(base)[0] for base in get_files_by_status("organized")
+    }
     for stage, dir_path in PIPELINE_CLEAN_TARGETS.items():
         abs_dir = dir_path
         if not os.path.exists(abs_dir):
             continue
         for item in os.listdir(abs_dir):
+            if item.startswith("."):
+                continue
             item_path = os.path.join(abs_dir, item)
             if stage == "stems":
                 namebase = item
@@ -86,6 +83,8 @@ def main():
 
     if args.live:
         print("=== LIVE CLEANUP: Deleting the following ===")
+        deleted = 0
+        errors = []
         for path in files_to_delete:
             try:
                 if os.path.isfile(path):
@@ -94,10 +93,17 @@ def main():
                 elif os.path.isdir(path):
                     print(f"Deleting directory: {path}")
                     shutil.rmtree(path)
-                notify_all("Maintenance Cleaned File", f"🧹 Deleted: {path}")
+                deleted += 1
             except Exception as e:
                 print(f"Error deleting {path}: {e}")
-                notify_all("Maintenance Error", f"❌ Error deleting {path}: {e}")
+                errors.append(f"{path}: {e}")
+        # One summary per run instead of one message per path.
+        notify_all("Maintenance Cleanup", f"🧹 Deleted {deleted} pipeline files/directories")
+        if errors:
+            notify_all(
+                "Maintenance Error",
+                f"❌ {len(errors)} cleanup errors:\n" + "\n".join(errors),
+            )
         print("Cleanup complete.")
     else:
         print("=== DRY RUN: Files/directories that would be cleaned up ===")
@@ -0,0 +1,50 @@
+import os
+import argparse
+import logging
+from shared.pipeline_utils import rebuild_status_index
+
+# Logging config
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+    "HEALTH": logging.INFO,
+}
+logging.basicConfig(
+    level=LEVELS.get(LOG_LEVEL, logging.INFO),
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Rebuild the per-status Redis index from existing file:* hashes. "
+            "Run once after upgrading, or to repair the index; transitions made "
+            "by running services during the rebuild are replayed before the swap."
+        )
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of file hashes read per pipelined round trip",
+    )
+    args = parser.parse_args()
+
+    counts = rebuild_status_index(batch_size=args.batch_size)
+    if not counts:
+        print("No file records found; status index is empty.")
+        return
+    print("=== Status index rebuilt ===")
+    for status, count in sorted(counts.items()):
+        print(f"{status}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,25 @@
 import os
-import json
 import logging
-import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask
 from mutagen.mp3 import MP3
 from shared.pipeline_utils import (
-    set_file_status,
-    get_files_by_status,
+    iter_stage_batches,
+    lease_keeper,
     set_file_error,
-    notify_all,
     clean_string,
-    redis_client,
     handle_auto_retry,
+    read_metadata_sidecar,
+    set_file_metadata,
+    set_files_metadata,
+    incr_metric,
+    set_metric,
+    worker_monitor,
+    start_worker,
+    health_response,
+    metrics_response,
 )
-import traceback
-import datetime
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 LEVELS = {
@@ -36,15 +40,23 @@ logger = logging.getLogger(__name__)
 logger.info(f"Logging initialized at {LOG_LEVEL} level")
 
 QUEUE_DIR = os.environ.get("QUEUE_DIR", "/queue")
-META_DIR = os.environ.get("META_DIR", "/metadata/json")
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 3))
 RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 5))
+# Files taken per batch and threads reading their headers concurrently.
+METADATA_BATCH_SIZE = int(os.environ.get("METADATA_BATCH_SIZE", 50))
+METADATA_WORKERS = int(os.environ.get("METADATA_WORKERS", 8))
 
 
 def extract_metadata(mp3_path):
+    """
+    Return (meta, audio fields) for a file, or None if it cannot be read.
+
+    mutagen reads the ID3 tag and the MPEG stream info (duration from the
+    Xing/VBRI header when present, else estimated from the bitrate).
+    """
     try:
         audio = MP3(mp3_path)
-        tags = audio.tags
+        tags, info = audio.tags, audio.info
         meta = {
             "TIT2": clean_string(tags.get("TIT2", "Unknown Title")) if tags else "Unknown Title",
             "TPE1": clean_string(tags.get("TPE1", "Unknown Artist")) if tags else "Unknown Artist",
@@ -52,55 +64,93 @@ def extract_metadata(mp3_path):
         }
         if tags:
             meta["TRCK"] = clean_string(tags.get("TRCK", ""))
-        return meta
+        return meta, {"duration": round(info.length, 3), "bitrate": info.bitrate}
     except Exception as e:
         logger.error(f"Metadata extraction failed for {mp3_path}: {e}")
         return None
 
 
+def merge_bot_metadata(file, meta):
+    """Metadata chosen in the Telegram bot wins over the file's tags."""
+    sidecar = read_metadata_sidecar(file)
+    if sidecar:
+        meta.update({k: v for k, v in sidecar.items() if v})
+    return meta
+
+
+def extract_one(file, file_path, owner):
+    """Single-file path with the usual auto-retry, for files a batch could not read."""
+
+    def extract_and_store():
+        result = extract_metadata(file_path)
+        if result is None:
+            raise Exception("Metadata extraction returned None")
+        meta, audio = result
+        set_file_metadata(
+            file,
+            merge_bot_metadata(file, meta),
+            extra=audio,
+            reset_retries="metadata",
+            owner=owner,
+        )
+        logger.info(f"Metadata extracted and status set for {file}")
+
+    try:
+        handle_auto_retry(
+            "metadata",
+            file,
+            func=extract_and_store,
+            max_retries=MAX_RETRIES,
+            retry_delay=RETRY_DELAY,
+            owner=owner,
+        )
+    except Exception as e:
+        # handle_auto_retry already marked the file as failed and notified.
+        logger.error(f"Metadata extraction gave up on {file}: {e}")
+
+
+def extract_batch(files, executor):
+    """Read a batch of headers concurrently and commit them in one Redis round trip."""
+    start = time.monotonic()
+    # The batch was claimed under one lease token.
+    owner = lease_keeper.token(files[0])
+    paths = {}
+    for file in files:
+        file_path = os.path.join(QUEUE_DIR, clean_string(file))
+        if os.path.exists(file_path):
+            paths[file] = file_path
+        else:
+            set_file_error(file, "File not found for metadata extraction", owner=owner)
+
+    entries = []
+    failed = []
+    for file, result in zip(paths, executor.map(extract_metadata, paths.values())):
+        if result is None:
+            failed.append(file)
+            continue
+        meta, audio = result
+        entries.append((file, merge_bot_metadata(file, meta), audio))
+    if entries:
+        set_files_metadata(entries, reset_retries="metadata", owner=owner)
+        logger.info(f"Metadata extracted and status set for {len(entries)} files")
+
+    for file in failed:
+        extract_one(file, paths[file], owner)
+
+    elapsed = time.monotonic() - start
+    incr_metric("metadata", "files_extracted_total", len(entries))
+    incr_metric("metadata", "batches_total")
+    incr_metric("metadata", "batch_seconds_sum", elapsed)
+    set_metric("metadata", "last_batch_size", len(files))
+
+
 def run_extractor():
-    os.makedirs(META_DIR, exist_ok=True)
-    while True:
-        files = get_files_by_status("queued")
-        for file in files:
-            file_path = os.path.join(QUEUE_DIR, clean_string(file))
-            if not os.path.exists(file_path):
-                set_file_error(file, "File not found for metadata extraction")
-                continue
-
-            def extract_and_store():
-                meta = extract_metadata(file_path)
-                if meta is not None:
-                    meta_path = os.path.join(
-                        META_DIR, os.path.splitext(file)[0] + ".mp3.json"
-                    )
-                    with open(meta_path, "w") as f:
-                        json.dump(meta, f)
-                    set_file_status(file, "metadata_extracted")
-                    redis_client.delete(f"metadata_retries:{file}")
-                    logger.info(f"Metadata extracted and status set for {file}")
-                else:
-                    raise Exception("Metadata extraction returned None")
-
-            try:
-                handle_auto_retry(
-                    "metadata",
-                    file,
-                    func=extract_and_store,
-                    max_retries=MAX_RETRIES,
-                    retry_delay=RETRY_DELAY,
-                )
-            except Exception as e:
-                tb = traceback.format_exc()
-                timestamp = datetime.datetime.now().isoformat()
-                error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
-                set_file_error(file, error_details)
-                notify_all(
-                    "Karaoke Pipeline Error",
-                    f"❌ Metadata extraction failed for {file}: {e}",
-                )
-                redis_client.incr(f"metadata_retries:{file}")
-        time.sleep(2)
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        for files in iter_stage_batches(
+            "queued", "metadata", METADATA_BATCH_SIZE, "extracting"
+        ):
+            with worker_monitor.job():
+                extract_batch(files, executor)
 
 
 app = Flask(__name__)
@@ -108,10 +158,14 @@ app = Flask(__name__)
 
 @app.route("/health")
 def health():
-    return "ok", 200
+    return health_response()
+
+
+@app.route("/metrics")
+def metrics():
+    return metrics_response()
 
 
 if __name__ == "__main__":
-    t = threading.Thread(target=run_extractor, daemon=True)
-    t.start()
+    start_worker("metadata", run_extractor)
     app.run(host="0.0.0.0", port=5000)
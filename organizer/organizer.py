@@ -1,21 +1,23 @@
 import os
-import shutil
-import threading
-import time
-import json
 import logging
 from flask import Flask
 from shared.pipeline_utils import (
     set_file_status,
-    get_files_by_status,
+    iter_stage_files,
+    lease_keeper,
     set_file_error,
     notify_all,
     clean_string,
-    redis_client,
     handle_auto_retry,
+    incr_metric,
+    setup_transfer_strategy,
+    transfer_file,
+    get_file_metadata,
+    worker_monitor,
+    start_worker,
+    health_response,
+    metrics_response,
 )
-import traceback
-import datetime
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 LEVELS = {
@@ -37,25 +39,18 @@ logger.info(f"Logging initialized at {LOG_LEVEL} level")
 
 OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "/output")
 ORG_DIR = os.environ.get("ORG_DIR", "/organized")
-META_DIR = os.environ.get("META_DIR", "/metadata/json")
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 3))
+RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 5))
 
 
-def get_metadata_from_json(file_path):
-    """Reads artist/album/title metadata from JSON file, or uses defaults."""
+def get_organize_metadata(file_path, file):
+    """Artist/album/title for the organized path (Redis, then JSON sidecar)."""
     base = os.path.basename(file_path)
-    json_file = os.path.join(META_DIR, base.replace("_karaoke.mp3", ".mp3.json"))
-    if os.path.exists(json_file):
-        try:
-            with open(json_file, encoding="utf-8") as f:
-                meta = json.load(f)
-            artist = str(meta.get("TPE1", "") or "UnknownArtist")
-            album = str(meta.get("TALB", "") or "UnknownAlbum")
-            title = str(meta.get("TIT2", "") or os.path.splitext(base)[0])
-            return artist, album, title
-        except Exception:
-            pass
-    return "UnknownArtist", "UnknownAlbum", os.path.splitext(base)[0]
+    meta = get_file_metadata(file) or {}
+    artist = str(meta.get("TPE1", "") or "UnknownArtist")
+    album = str(meta.get("TALB", "") or "UnknownAlbum")
+    title = str(meta.get("TIT2", "") or os.path.splitext(base)[0])
+    return artist, album, title
 
 
 def is_valid_karaoke_mp3(filename):
@@ -63,63 +58,54 @@ def is_valid_karaoke_mp3(filename):
     return filename.endswith("_karaoke.mp3")
 
 
-def organize_file(file_path, file):
-    try:
-        artist, album, title = get_metadata_from_json(file_path)
-        artist = clean_string(artist)
-        album = clean_string(album)
-        title = clean_string(title)
-        out_dir = os.path.join(ORG_DIR, artist, album)
-        os.makedirs(out_dir, exist_ok=True)
-        dest_file = os.path.join(out_dir, os.path.basename(file_path))
-        if not os.path.exists(dest_file):
-            shutil.copy2(file_path, dest_file)
-            notify_all(
-                "Karaoke Pipeline Success",
-                f"🎵 Karaoke organized: {os.path.basename(file_path)} → {artist}/{album}",
-            )
-    except Exception as e:
-        tb = traceback.format_exc()
-        timestamp = datetime.datetime.now().isoformat()
-        error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
-        set_file_error(file, error_details)
+def organize_file(file_path, file, strategy="copy"):
+    """Move a karaoke MP3 into ORG_DIR/<artist>/<album>; raises on failure (retried by the caller)."""
+    artist, album, title = get_organize_metadata(file_path, file)
+    artist = clean_string(artist)
+    album = clean_string(album)
+    title = clean_string(title)
+    out_dir = os.path.join(ORG_DIR, artist, album)
+    os.makedirs(out_dir, exist_ok=True)
+    dest_file = os.path.join(out_dir, os.path.basename(file_path))
+    if not os.path.exists(dest_file):
+        used = transfer_file(file_path, dest_file, strategy)
+        incr_metric("organizer", f'transfers_total{{strategy="{used}"}}')
         notify_all(
-            "Karaoke Pipeline Error", f"Organizer error for {file} at {timestamp}:\n{e}"
+            "Karaoke Pipeline Success",
+            f"🎵 Karaoke organized: {os.path.basename(file_path)} → {artist}/{album}",
         )
-        redis_client.incr(f"organizer_retries:{file}")
 
 
 def run_organizer():
     os.makedirs(ORG_DIR, exist_ok=True)
-    while True:
-        files = get_files_by_status("packaged")
-        for file in files:
-            file_path = os.path.join(OUTPUT_DIR, file.replace(".mp3", "_karaoke.mp3"))
-            if not (
-                is_valid_karaoke_mp3(os.path.basename(file_path))
-                and os.path.exists(file_path)
-            ):
-                continue
-
-            def org_func():
-                organize_file(file_path, file)
-                set_file_status(file, "organized")
-
-            try:
+    strategy = setup_transfer_strategy("organizer", OUTPUT_DIR, ORG_DIR)
+    for file in iter_stage_files("packaged", "organizer", "organizing"):
+        file_path = os.path.join(OUTPUT_DIR, file.replace(".mp3", "_karaoke.mp3"))
+        owner = lease_keeper.token(file)
+        if not (
+            is_valid_karaoke_mp3(os.path.basename(file_path))
+            and os.path.exists(file_path)
+        ):
+            set_file_error(file, "Packaged karaoke file not found for organizing", owner=owner)
+            continue
+
+        def org_func():
+            organize_file(file_path, file, strategy)
+            set_file_status(file, "organized", reset_retries="organizer", owner=owner)
+
+        try:
+            with worker_monitor.job():
                 handle_auto_retry(
-                    "organizer", file, func=org_func, max_retries=MAX_RETRIES
+                    "organizer",
+                    file,
+                    func=org_func,
+                    max_retries=MAX_RETRIES,
+                    retry_delay=RETRY_DELAY,
+                    owner=owner,
                 )
-            except Exception as e:
-                tb = traceback.format_exc()
-                timestamp = datetime.datetime.now().isoformat()
-                error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
-                set_file_error(file, error_details)
-                notify_all(
-                    "Karaoke Pipeline Error",
-                    f"Organizer error for {file} at {timestamp}:\n{e}",
-                )
-                redis_client.incr(f"organizer_retries:{file}")
-        time.sleep(10)
+        except Exception as e:
+            # handle_auto_retry already marked the file as failed and notified.
+            logger.error(f"Organizer gave up on {file}: {e}")
 
 
 app = Flask(__name__)
@@ -127,10 +113,14 @@ app = Flask(__name__)
 
 @app.route("/health")
 def health():
-    return "ok", 200
+    return health_response()
+
+
+@app.route("/metrics")
+def metrics():
+    return metrics_response()
 
 
 if __name__ == "__main__":
-    t = threading.Thread(target=run_organizer, daemon=True)
-    t.start()
+    start_worker("organizer", run_organizer)
     app.run(host="0.0.0.0", port=5000)
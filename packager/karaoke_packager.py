@@ -1,21 +1,37 @@
 import os
-import json
 import logging
+import subprocess
+import threading
 import time
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, APIC
-from pydub import AudioSegment
+import functools
+from flask import Flask
+from concurrent.futures import ThreadPoolExecutor
 from shared.pipeline_utils import (
     set_file_status,
     get_files_by_status,
+    get_status_counts,
+    get_file_records,
+    iter_stage_files,
+    lease_keeper,
+    queue_telegram_audio,
+    PRIORITY_FIELD,
+    PREVIEW_FIELD,
+    PREVIEW_STEM_FILE,
+    PREVIEW_SUFFIX,
+    PREVIEW_FULL_PRIORITY,
     set_file_error,
     notify_all,
     clean_string,
-    redis_client,
     handle_auto_retry,
+    incr_metric,
+    set_metric,
+    get_file_metadata,
+    with_metadata_defaults,
+    worker_monitor,
+    start_worker,
+    health_response,
+    metrics_response,
 )
-import traceback
-import datetime
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 LEVELS = {
@@ -41,115 +57,226 @@ META_DIR = os.environ.get("META_DIR", "/metadata/json")
 OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "/output")
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 3))
 RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 5))
+MP3_BITRATE = os.environ.get("MP3_BITRATE", "128k")
+# Concurrent encode jobs. Each is a thread driving its own ffmpeg process,
+# so notifications and uploads stay on this process's dispatcher.
+PACKAGER_WORKERS = int(os.environ.get("PACKAGER_WORKERS", 2))
 
 
-def robust_load_metadata(meta_path):
-    """Load metadata JSON, falling back to defaults if not present."""
-    fallback = {
-        "TIT2": "Unknown Title",
-        "TPE1": "Unknown Artist",
-        "TALB": "Unknown Album",
-    }
-    if not os.path.exists(meta_path):
-        logger.warning(f"Metadata file missing: {meta_path}")
-        return fallback
+def build_encode_command(instrumental_path, meta, cover_path, out_path):
+    """ffmpeg command that encodes the WAV and writes ID3 tags + cover in one pass."""
+    cmd = ["ffmpeg", "-v", "error", "-y", "-i", instrumental_path]
+    if cover_path:
+        cmd += ["-i", cover_path]
+    cmd += ["-map", "0:a", "-c:a", "libmp3lame", "-b:a", MP3_BITRATE]
+    if cover_path:
+        cmd += [
+            "-map",
+            "1:v",
+            "-c:v",
+            "copy",
+            "-disposition:v",
+            "attached_pic",
+            "-metadata:s:v",
+            "title=Cover",
+            "-metadata:s:v",
+            "comment=Cover (front)",
+        ]
+    cmd += [
+        "-map_metadata",
+        "-1",
+        "-id3v2_version",
+        "3",
+        "-metadata",
+        f"title={meta.get('TIT2')}",
+        "-metadata",
+        f"artist={meta.get('TPE1')}",
+        "-metadata",
+        f"album={meta.get('TALB')}",
+        "-f",
+        "mp3",
+        out_path,
+    ]
+    return cmd
+
+
+def apply_metadata(instrumental_path, meta, cover_path, out_path):
+    """
+    Encode accompaniment.wav to a tagged karaoke MP3 in a single write.
+
+    The WAV is streamed straight into the encoder, ID3 tags (and APIC cover art,
+    when present) are written by the same ffmpeg pass, and the result is written
+    under a hidden temp name and atomically renamed, so the organizer never sees
+    a partial file.
+    """
+    meta = with_metadata_defaults(meta)
+    if cover_path and not os.path.exists(cover_path):
+        cover_path = None
+    out_dir, out_name = os.path.split(out_path)
+    tmp_path = os.path.join(out_dir, f".{out_name}.part")
+    result = subprocess.run(
+        build_encode_command(instrumental_path, meta, cover_path, tmp_path),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise RuntimeError(f"ffmpeg encode error: {result.stderr}")
+    os.replace(tmp_path, out_path)
+
+
+def finish_preview(file, out_path, owner):
+    """Deliver a packaged preview and queue the file for its full separation."""
+    if not set_file_status(
+        file,
+        "metadata_extracted",
+        extra={PREVIEW_FIELD: "packaged", PRIORITY_FIELD: PREVIEW_FULL_PRIORITY},
+        reset_retries="packager",
+        owner=owner,
+    ):
+        return
+    name = os.path.basename(out_path)
+    # Uploaded in the background: the packager never waits on Telegram.
+    queue_telegram_audio(out_path, f"🎧 Preview: {name} (full quality on the way)")
+    notify_all(
+        "Karaoke Pipeline Preview",
+        f"🎧 Preview track produced: {name}; full separation queued",
+    )
+
+
+def remove_preview(song_name):
+    """The full-quality track replaces the preview (and its stem)."""
+    for path in (
+        os.path.join(OUTPUT_DIR, f"{song_name}{PREVIEW_SUFFIX}"),
+        os.path.join(STEMS_DIR, song_name, PREVIEW_STEM_FILE),
+    ):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def package_file(file, owner):
+    """
+    Package one claimed file (or its preview). Runs in a pool thread;
+    `owner` is the token of the loop's claim, guarding the status writes.
+    """
+    start = time.monotonic()
+    song_name = clean_string(os.path.splitext(file)[0])
+    cover_path = os.path.join(META_DIR, f"{song_name}.mp3_cover.jpg")
+    preview = get_file_records([file])[0].get(PREVIEW_FIELD) == "split"
+    if preview:
+        inst_path = os.path.join(STEMS_DIR, song_name, PREVIEW_STEM_FILE)
+        out_path = os.path.join(OUTPUT_DIR, f"{song_name}{PREVIEW_SUFFIX}")
+    else:
+        inst_path = os.path.join(STEMS_DIR, song_name, "accompaniment.wav")
+        out_path = os.path.join(OUTPUT_DIR, f"{song_name}_karaoke.mp3")
+
+    if not os.path.exists(inst_path):
+        set_file_error(file, f"Missing {os.path.basename(inst_path)} for {song_name}", owner=owner)
+        return
+    meta = get_file_metadata(file)
+    if meta is None:
+        set_file_error(file, f"Missing metadata for {song_name}", owner=owner)
+        return
+    if not preview and os.path.exists(out_path):
+        remove_preview(song_name)
+        set_file_status(file, "packaged", owner=owner)
+        return
+
+    def package_func():
+        apply_metadata(inst_path, meta, cover_path, out_path)
+        if preview:
+            finish_preview(file, out_path, owner)
+            return
+        remove_preview(song_name)
+        if set_file_status(file, "packaged", reset_retries="packager", owner=owner):
+            notify_all(
+                "Karaoke Pipeline Success",
+                f"✅ Karaoke track produced: {os.path.basename(out_path)}",
+            )
+
     try:
-        with open(meta_path, "r", encoding="utf-8") as f:
-            meta = json.load(f)
-        for k in fallback:
-            if k not in meta or not meta[k]:
-                meta[k] = fallback[k]
-        return meta
+        handle_auto_retry(
+            "packager",
+            file,
+            func=package_func,
+            max_retries=MAX_RETRIES,
+            retry_delay=RETRY_DELAY,
+            owner=owner,
+        )
     except Exception as e:
-        logger.error(f"Metadata JSON error in {meta_path}: {e}")
-        return fallback
+        # handle_auto_retry already marked the file as failed and notified.
+        logger.error(f"Packager gave up on {song_name}: {e}")
+    finally:
+        elapsed = time.monotonic() - start
+        incr_metric("packager", "jobs_total")
+        incr_metric("packager", "job_seconds_sum", elapsed)
+        set_metric("packager", "last_job_seconds", round(elapsed, 3))
 
 
-def clean_mp3_tags(mp3_path, meta):
-    audio = MP3(mp3_path)
-    audio.delete()
-    audio.save()
-    audio = MP3(mp3_path, ID3=ID3)
-    try:
-        audio.add_tags()
-    except Exception:
-        pass
-    audio.tags.add(TIT2(encoding=3, text=meta.get("TIT2")))
-    audio.tags.add(TPE1(encoding=3, text=meta.get("TPE1")))
-    audio.tags.add(TALB(encoding=3, text=meta.get("TALB")))
-    audio.save()
-
-
-def apply_metadata(instrumental_path, meta_path, out_path):
-    audio = AudioSegment.from_wav(instrumental_path)
-    audio.export(out_path, format="mp3")
-    meta = robust_load_metadata(meta_path)
-    clean_mp3_tags(out_path, meta)
-    cover_path = meta_path.replace(".json", "_cover.jpg")
-    if os.path.exists(cover_path):
-        audiofile = MP3(out_path, ID3=ID3)
-        with open(cover_path, "rb") as albumart:
-            audiofile.tags.add(
-                APIC(
-                    encoding=3,
-                    mime="image/jpeg",
-                    type=3,
-                    desc="Cover",
-                    data=albumart.read(),
-                )
-            )
-        audiofile.save()
+def requeue_interrupted():
+    """
+    Hand files left in 'packaging' without a lease (claimed before leases
+    existed) back to the queue; leased ones are reclaimed once they expire.
+    """
+    files = get_files_by_status("packaging")
+    for file, record in zip(files, get_file_records(files)):
+        if not record.get("lease_owner"):
+            logger.warning(f"Re-queuing {file} interrupted during packaging")
+            set_file_status(file, "split")
 
 
 def run_packager():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    while True:
-        files = get_files_by_status("split")
-        for file in files:
-            song_name = clean_string(os.path.splitext(file)[0])
-            inst_path = os.path.join(STEMS_DIR, song_name, "accompaniment.wav")
-            meta_path = os.path.join(META_DIR, f"{song_name}.mp3.json")
-            out_path = os.path.join(OUTPUT_DIR, f"{song_name}_karaoke.mp3")
-
-            if not os.path.exists(inst_path):
-                set_file_error(file, f"Missing accompaniment.wav for {song_name}")
-                continue
-            if not os.path.exists(meta_path):
-                set_file_error(file, f"Missing metadata JSON for {song_name}")
-                continue
-            if os.path.exists(out_path):
-                set_file_status(file, "packaged")
+    requeue_interrupted()
+    slots = threading.BoundedSemaphore(PACKAGER_WORKERS)
+    in_flight = []
+
+    def on_done(file, token, submitted, future):
+        worker_monitor.job_finished(time.monotonic() - submitted)
+        lease_keeper.release(file, token=token)
+        in_flight.remove(file)
+        set_metric("packager", "jobs_in_flight", len(in_flight))
+        slots.release()
+        if future.exception() is not None:
+            set_file_error(file, f"Packaging worker failed: {future.exception()}", owner=token)
+
+    with ThreadPoolExecutor(max_workers=PACKAGER_WORKERS, thread_name_prefix="package") as executor:
+        for file in iter_stage_files("split", "packager"):
+            # Blocks while all workers are busy, so unclaimed files stay
+            # "split" for other packager replicas.
+            while not slots.acquire(timeout=5):
+                worker_monitor.beat()
+            # Claimed here rather than by iter_stage_files, so the lease is
+            # renewed until the pool finishes the job (released in on_done).
+            token = lease_keeper.claim(file, "split", "packaging")
+            if not token:
+                slots.release()
                 continue
+            in_flight.append(file)
+            set_metric("packager", "jobs_in_flight", len(in_flight))
+            set_metric("packager", "queue_depth", get_status_counts(["split"])["split"])
+            worker_monitor.job_started()
+            future = executor.submit(package_file, file, token)
+            future.add_done_callback(
+                functools.partial(on_done, file, token, time.monotonic())
+            )
+
+
+app = Flask(__name__)
+
+
+@app.route("/health")
+def health():
+    return health_response()
+
 
-            def package_func():
-                apply_metadata(inst_path, meta_path, out_path)
-                set_file_status(file, "packaged")
-                redis_client.delete(f"packager_retries:{file}")
-                notify_all(
-                    "Karaoke Pipeline Success",
-                    f"✅ Karaoke track produced: {os.path.basename(out_path)}",
-                )
-
-            try:
-                handle_auto_retry(
-                    "packager",
-                    file,
-                    func=package_func,
-                    max_retries=MAX_RETRIES,
-                    retry_delay=RETRY_DELAY,
-                )
-            except Exception as e:
-                tb = traceback.format_exc()
-                timestamp = datetime.datetime.now().isoformat()
-                error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
-                set_file_error(file, error_details)
-                notify_all(
-                    "Karaoke Pipeline Error",
-                    f"❌ Packaging failed for {song_name}: {e}",
-                )
-                redis_client.incr(f"packager_retries:{file}")
-        time.sleep(2)
+@app.route("/metrics")
+def metrics():
+    return metrics_response()
 
 
 if __name__ == "__main__":
-    run_packager()
+    start_worker("packager", run_packager)
+    app.run(host="0.0.0.0", port=5000)
@@ -1,15 +1,19 @@
 """
 Pipeline utility functions shared across all karaoke-mvp services.
 
-- Status and error tracking (via Redis)
+- Status and error tracking (via Redis), with a per-status index
 - Retry logic per stage
+- Per-service metrics stored in Redis
+- Song metadata stored with the file's status record (JSON sidecar optional)
 - Notification helpers (Telegram, Slack, Email) with hardened, explicit logging
 - String sanitation for filenames
-- Health endpoint
+- Zero-copy file transfer between pipeline directories
+- Worker heartbeats, health and per-process /metrics
 - All directory/file paths configurable via environment variables
 """
 
 import os
+import json
 import logging
 import redis
 import requests
@@ -17,7 +21,20 @@ import smtplib
 from email.message import EmailMessage
 import traceback
 import datetime
+import socket
 import time
+import errno
+import fcntl
+import shutil
+import tempfile
+import resource
+import threading
+import contextlib
+import queue
+import random
+import atexit
+import uuid
+import collections
 
 # -------- LOGGING SETUP --------
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -44,8 +61,40 @@ SMTP_SERVER = os.environ.get("SMTP_SERVER")
 SMTP_PORT = int(os.environ.get("SMTP_PORT", 587))
 SMTP_USERNAME = os.environ.get("SMTP_USERNAME")
 SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD")
+# Notifications are sent by a background dispatcher: at most
+# NOTIFY_RATE_PER_MINUTE sends, bursts beyond that are coalesced into one
+# digest, and NOTIFY_DIGEST_SECONDS > 0 always batches over that window.
+NOTIFY_RATE_PER_MINUTE = float(os.environ.get("NOTIFY_RATE_PER_MINUTE", 20))
+NOTIFY_DIGEST_SECONDS = float(os.environ.get("NOTIFY_DIGEST_SECONDS", 0))
+NOTIFY_QUEUE_SIZE = int(os.environ.get("NOTIFY_QUEUE_SIZE", 1000))
 REDIS_HOST = os.environ.get("REDIS_HOST", "redis")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+# Connections per process; callers wait for a free one instead of failing.
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 32))
+
+# Stage handoff via Redis Streams consumer groups
+CONSUMER_NAME = os.environ.get("CONSUMER_NAME", socket.gethostname())
+STAGE_STREAM_MAXLEN = int(os.environ.get("STAGE_STREAM_MAXLEN", 10000))
+STAGE_BLOCK_MS = int(os.environ.get("STAGE_BLOCK_MS", 5000))
+STAGE_RECLAIM_IDLE_MS = int(os.environ.get("STAGE_RECLAIM_IDLE_MS", 30 * 60 * 1000))
+# A claimed job is leased to its worker for this long and renewed while it
+# runs; leases that run out (crashed worker) are handed back to the queue.
+LEASE_SECONDS = float(os.environ.get("LEASE_SECONDS", 120))
+# Attempts per stage (same variable the stage services read); an expired
+# lease counts as one, so a job that keeps killing its worker ends in error.
+MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 3))
+# Failed jobs are retried after RETRY_DELAY * 2^(attempt-1) seconds (per-stage
+# RETRY_DELAY), with jitter, capped at RETRY_BACKOFF_MAX.
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", 900))
+# Splitter scheduling: lowest priority class first, shortest job first within
+# a class; every SCHEDULER_AGING_SECONDS a job waits moves it up one class.
+SCHEDULER_AGING_SECONDS = float(os.environ.get("SCHEDULER_AGING_SECONDS", 7200))
+# Sources whose files get an instant DSP preview before the full separation,
+# which then runs at priority class PREVIEW_FULL_PRIORITY.
+PREVIEW_SOURCES = [s for s in os.environ.get("PREVIEW_SOURCES", "bot").split(",") if s]
+PREVIEW_FULL_PRIORITY = int(os.environ.get("PREVIEW_FULL_PRIORITY", 2))
+# /health fails once a worker loop has not made progress for this long.
+HEARTBEAT_STALE_SECONDS = int(os.environ.get("HEARTBEAT_STALE_SECONDS", 300))
 
 # Directories (env-based, defaulting to Compose/Docker structure)
 QUEUE_DIR = os.environ.get("QUEUE_DIR", "/queue")
@@ -55,9 +104,29 @@ OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "/output")
 ORG_DIR = os.environ.get("ORG_DIR", "/organized")
 INPUT_DIR = os.environ.get("INPUT_DIR", "/input")
 LOGS_DIR = os.environ.get("LOGS_DIR", "/logs")
+# INPUT_DIR subdirectories that tag where a file came from (see input_source)
+BOT_INPUT_SUBDIR = os.environ.get("BOT_INPUT_SUBDIR", "telegram")
+BULK_INPUT_SUBDIR = os.environ.get("BULK_INPUT_SUBDIR", "bulk")
+
+# Also write metadata to META_DIR/<song>.mp3.json (it always lives in Redis)
+META_JSON_EXPORT = os.environ.get("META_JSON_EXPORT", "false").lower() in ("1", "true", "yes")
+
+# File transfer between stage directories: auto|hardlink|reflink|rename|copy
+TRANSFER_STRATEGY = os.environ.get("TRANSFER_STRATEGY", "auto").lower()
 
 # -------- REDIS CLIENT (singleton) --------
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# One explicit, bounded pool per process shared by every thread (stage loop,
+# executors, dispatcher, Flask). redis-py resets it in forked children.
+redis_pool = redis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=10,
+    socket_keepalive=True,
+    health_check_interval=30,
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
 
 # -------- STRING SANITIZATION --------
 
@@ -69,66 +138,1397 @@ def clean_string(s):
     # Remove null bytes, slashes, and whitespace
     return s.replace("\x00", "").replace("/", "-").replace("\\", "-").strip()
 
+# -------- FILE TRANSFER --------
+
+
+TRANSFER_STRATEGIES = ("hardlink", "reflink", "rename", "copy")
+# Linux FICLONE ioctl: share extents copy-on-write (btrfs, XFS, bcachefs, ...).
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+_TRANSFER_OPS = {
+    "hardlink": os.link,
+    "reflink": _reflink,
+    "rename": os.rename,
+    "copy": shutil.copy2,
+}
+
+
+def _transfer_via_temp(op, src, dst):
+    """Run `op` into a temp name beside dst, then atomically replace dst."""
+    fd, tmp = tempfile.mkstemp(prefix=".transfer-", dir=os.path.dirname(dst) or ".")
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        op(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # Also covers replace() being a no-op when tmp and dst are already
+        # hardlinks to the same inode (re-enqueueing an unchanged file).
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+def detect_transfer_strategy(src_dir, dst_dir, preferred=TRANSFER_STRATEGY):
+    """
+    Pick the cheapest working transfer strategy for a directory pair.
+
+    "auto" probes hardlink, then reflink, and falls back to copy (e.g. across
+    filesystems). "rename" is never chosen automatically because it removes the
+    source; an explicitly configured strategy is probed and falls back to copy
+    if it does not work for this pair.
+    """
+    if preferred == "auto":
+        candidates = ["hardlink", "reflink"]
+    elif preferred in TRANSFER_STRATEGIES:
+        candidates = [preferred]
+    else:
+        logger.warning(f"Unknown TRANSFER_STRATEGY '{preferred}', using auto")
+        candidates = ["hardlink", "reflink"]
+    for strategy in candidates:
+        if strategy == "copy":
+            return "copy"
+        probe_src = probe_dst = None
+        try:
+            fd, probe_src = tempfile.mkstemp(prefix=".transfer-probe-", dir=src_dir)
+            os.write(fd, b"probe")
+            os.close(fd)
+            probe_dst = os.path.join(dst_dir, os.path.basename(probe_src))
+            _TRANSFER_OPS[strategy](probe_src, probe_dst)
+            return strategy
+        except OSError as e:
+            logger.info(f"Transfer strategy {strategy} unavailable for {src_dir} -> {dst_dir}: {e}")
+        finally:
+            for path in (probe_src, probe_dst):
+                if path and os.path.lexists(path):
+                    os.remove(path)
+    return "copy"
+
+
+def setup_transfer_strategy(service, src_dir, dst_dir):
+    """Detect the strategy for a directory pair at startup and report it."""
+    strategy = detect_transfer_strategy(src_dir, dst_dir)
+    logger.info(f"Transfer strategy {src_dir} -> {dst_dir}: {strategy}")
+    set_metric(service, f'transfer_strategy_info{{strategy="{strategy}"}}', 1)
+    return strategy
+
+
+def transfer_file(src, dst, strategy):
+    """
+    Move file data from src to dst using `strategy`; return the strategy used.
+
+    dst is replaced atomically. If the strategy fails for this file (for example
+    EXDEV across filesystems), the file is copied instead.
+    """
+    try:
+        _transfer_via_temp(_TRANSFER_OPS[strategy], src, dst)
+        return strategy
+    except OSError as e:
+        if strategy == "copy":
+            raise
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EMLINK):
+            raise
+        logger.warning(f"{strategy} failed for {src} ({e}); copying instead")
+        _transfer_via_temp(shutil.copy2, src, dst)
+        return "copy"
+
+
 # -------- STATUS & ERROR MANAGEMENT --------
 
 
-def set_file_status(filename, status, error=None, extra=None):
-    """Set file status in Redis, optionally adding error or extra info."""
-    key = f"file:{filename}"
-    value = {"status": status}
+# Per-status sorted sets ("status_index:<status>", scored by transition time) let
+# stage loops fetch their work with one ZRANGE instead of scanning every file:* hash.
+STATUS_INDEX_PREFIX = "status_index:"
+# Every status write is also published to "stage_events:<status>", which the
+# stage consuming that status reads with XREADGROUP instead of sleep-polling.
+STAGE_STREAM_PREFIX = "stage_events:"
+# Bumped by every status write (and metadata merge); readers use it to tell
+# whether anything changed.
+STATUS_VERSION_KEY = "status_version"
+# Transition counters ("from>to" -> count) and per-status latency histograms,
+# maintained by the status script at write time so /metrics never scans files.
+# Histogram hashes hold "<status>|<le>" bucket counts (not cumulative) plus
+# "<status>|sum" and "<status>|count".
+TRANSITIONS_KEY = "stats:transitions"
+HISTOGRAM_PREFIX = "stats:hist:"
+QUEUE_WAIT_HISTOGRAM = "stage_queue_wait_seconds"
+PROCESSING_HISTOGRAM = "stage_processing_seconds"
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+# Set when a stage picks a file up, splitting its time in a status into queue
+# wait (entered -> picked up) and processing (picked up -> left).
+STARTED_AT_FIELD = "stage_started_at"
+# A claimed file carries its lease in these hash fields ("from" is the status
+# it was claimed from, where it goes back if the lease expires) and is listed
+# in LEASES_KEY scored by expiry. Any status change ends the lease. The owner
+# is a token unique to each claim (LEASE_OWNER plus a random suffix), so a job
+# whose lease was reclaimed cannot write over a later claim of the same file,
+# even one made by the same process.
+LEASE_OWNER_FIELD = "lease_owner"
+LEASE_EXPIRES_FIELD = "lease_expires"
+LEASE_FROM_FIELD = "lease_from"
+LEASES_KEY = "leases"
+LEASE_OWNER = CONSUMER_NAME
+
+# Atomically moves a file between status index sets while updating its hash,
+# then publishes the transition to the stream for the new status and bumps
+# the global status version. On a status change it also counts the transition,
+# observes the queue wait / processing time spent in the previous status and
+# drops the previous status's lease; a write that sets LEASE_EXPIRES_FIELD
+# (a claim) registers the new lease, counts as the pickup of the file and
+# starts the clock for the claimed status.
+# KEYS[1] = file hash, KEYS[2..] = keys to delete (e.g. retry counters);
+# ARGV = filename, status, timestamp, stream maxlen, expected current status
+# ('' = any), space-separated hash fields to remove, expected lease owner
+# ('' = any), "<zset> <score>" to add the file to once applied (e.g. a retry
+# schedule; '' = none), then field/value pairs.
+# Returns {applied (0/1), previous status}.
+_SET_STATUS_LUA = """
+local state = redis.call('HMGET', KEYS[1], 'status', 'updated_at',
+  '""" + STARTED_AT_FIELD + """', '""" + LEASE_OWNER_FIELD + """')
+local prev = state[1]
+if ARGV[5] ~= '' and prev ~= ARGV[5] then
+  return {0, prev or ''}
+end
+if ARGV[7] ~= '' and state[4] ~= ARGV[7] then
+  return {0, prev or ''}
+end
+local changed = prev ~= ARGV[2]
+local buckets = {""" + ", ".join(str(b) for b in LATENCY_BUCKETS) + """}
+local function observe(name, status, value)
+  local key = '""" + HISTOGRAM_PREFIX + """' .. name
+  local le = '+Inf'
+  for _, bound in ipairs(buckets) do
+    if value <= bound then
+      le = tostring(bound)
+      break
+    end
+  end
+  redis.call('HINCRBY', key, status .. '|' .. le, 1)
+  redis.call('HINCRBYFLOAT', key, status .. '|sum', value)
+  redis.call('HINCRBY', key, status .. '|count', 1)
+end
+if #KEYS > 1 then
+  redis.call('DEL', unpack(KEYS, 2))
+end
+if changed then
+  redis.call('HDEL', KEYS[1], '""" + STARTED_AT_FIELD + """', '""" + LEASE_OWNER_FIELD + """',
+    '""" + LEASE_EXPIRES_FIELD + """', '""" + LEASE_FROM_FIELD + """')
+  redis.call('ZREM', '""" + LEASES_KEY + """', ARGV[1])
+end
+for field in string.gmatch(ARGV[6], '%S+') do
+  redis.call('HDEL', KEYS[1], field)
+end
+if #ARGV > 8 then
+  redis.call('HSET', KEYS[1], unpack(ARGV, 9))
+end
+if ARGV[8] ~= '' then
+  local zset, score = string.match(ARGV[8], '^(%S+) (%S+)$')
+  redis.call('ZADD', zset, score, ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2], 'updated_at', ARGV[3])
+local lease = redis.call('HGET', KEYS[1], '""" + LEASE_EXPIRES_FIELD + """')
+if lease then
+  redis.call('ZADD', '""" + LEASES_KEY + """', lease, ARGV[1])
+end
+if changed then
+  if prev then
+    redis.call('ZREM', '""" + STATUS_INDEX_PREFIX + """' .. prev, ARGV[1])
+  end
+  redis.call('ZADD', '""" + STATUS_INDEX_PREFIX + """' .. ARGV[2], ARGV[3], ARGV[1])
+  redis.call('HINCRBY', '""" + TRANSITIONS_KEY + """', (prev or 'new') .. '>' .. ARGV[2], 1)
+  local entered = tonumber(state[2])
+  local started = tonumber(state[3])
+  if lease and not started then
+    started = tonumber(ARGV[3])
+  end
+  if prev and entered and started and started >= entered then
+    observe('""" + QUEUE_WAIT_HISTOGRAM + """', prev, started - entered)
+    observe('""" + PROCESSING_HISTOGRAM + """', prev, math.max(tonumber(ARGV[3]) - started, 0))
+  end
+  if lease then
+    redis.call('HSET', KEYS[1], '""" + STARTED_AT_FIELD + """', ARGV[3])
+  end
+else
+  redis.call('ZADD', '""" + STATUS_INDEX_PREFIX + """' .. ARGV[2], 'NX', ARGV[3], ARGV[1])
+end
+redis.call('XADD', '""" + STAGE_STREAM_PREFIX + """' .. ARGV[2], 'MAXLEN', '~', ARGV[4], '*',
+  'filename', ARGV[1], 'prev', prev or '')
+redis.call('INCR', '""" + STATUS_VERSION_KEY + """')
+return {1, prev or ''}
+"""
+_set_status_script = redis_client.register_script(_SET_STATUS_LUA)
+
+
+RETRY_STAGES = ("metadata", "splitter", "packager", "organizer")
+# The stage (retry counter) consuming each status.
+STATUS_STAGES = {
+    "queued": "metadata",
+    "metadata_extracted": "splitter",
+    "split": "packager",
+    "packaged": "organizer",
+}
+
+
+def retry_key(stage, filename):
+    return f"{stage}_retries:{filename}"
+
+
+def _retry_keys(stages, filename):
+    if not stages:
+        return []
+    if isinstance(stages, str):
+        stages = [stages]
+    return [retry_key(stage, filename) for stage in stages]
+
+
+def _set_status_call(
+    filename, status, expected, value, delete_keys=(), remove_fields=(), owner=None, schedule=None
+):
+    """(keys, args) for one _SET_STATUS_LUA call; `schedule` is a (zset, score) pair."""
+    args = [
+        filename,
+        status,
+        time.time(),
+        STAGE_STREAM_MAXLEN,
+        expected or "",
+        " ".join(remove_fields),
+        owner or "",
+        " ".join(str(part) for part in schedule) if schedule else "",
+    ]
+    for field, val in value.items():
+        args.extend([field, val])
+    return [f"file:{filename}", *delete_keys], args
+
+
+def _run_set_status(
+    filename, status, expected, value, delete_keys=(), remove_fields=(), owner=None
+):
+    keys, args = _set_status_call(
+        filename, status, expected, value, delete_keys, remove_fields, owner
+    )
+    applied, _ = _set_status_script(keys=keys, args=args)
+    return bool(applied)
+
+
+def set_file_status(
+    filename, status, error=None, extra=None, reset_retries=None, owner=None, remove_fields=()
+):
+    """Set file status in Redis, optionally adding error or extra info.
+
+    The hash update, the move between status index sets and the stage event
+    publish happen in a single Lua script, so readers never see a file in two
+    statuses (or none) and the next stage is woken up immediately.
+    `reset_retries` (a stage name or list of them) clears those retry counters
+    and `remove_fields` drops those hash fields in the same round trip. With
+    `owner`, the write only applies while that owner still holds the file's
+    lease; returns whether it was applied.
+    """
+    value = {}
     if error:
         value["error"] = error
     if extra:
         value.update(extra)
     try:
-        redis_client.hset(key, mapping=value)
+        applied = _run_set_status(
+            filename,
+            status,
+            None,
+            value,
+            _retry_keys(reset_retries, filename),
+            remove_fields,
+            owner,
+        )
     except Exception as e:
         logger.error(f"Redis set_file_status error: {e}")
+        return False
+    if not applied:
+        logger.warning(f"Not moving {filename} to {status}: lease lost by {owner}")
+    return applied
+
+
+def set_file_statuses(updates, reset_retries=None, owner=None):
+    """
+    Apply many [(filename, status, extra)] transitions in one pipelined round
+    trip; each transition is still atomic. `reset_retries` and `owner` apply
+    to every file, as in set_file_status().
+    """
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for filename, status, extra in updates:
+            keys, args = _set_status_call(
+                filename,
+                status,
+                None,
+                extra or {},
+                _retry_keys(reset_retries, filename),
+                owner=owner,
+            )
+            _set_status_script(keys=keys, args=args, client=pipe)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis set_file_statuses error: {e}")
+
+
+def _lease_fields(from_status, owner, lease_seconds):
+    return {
+        LEASE_OWNER_FIELD: owner,
+        LEASE_EXPIRES_FIELD: time.time() + lease_seconds,
+        LEASE_FROM_FIELD: from_status,
+    }
+
+
+def claim_file(
+    filename, from_status, to_status, extra=None, owner=None, lease_seconds=LEASE_SECONDS
+):
+    """
+    Atomically move a file from `from_status` to `to_status`.
+
+    Returns True only for the caller that performed the transition, so
+    concurrent workers never pick up the same file twice. With `owner`, the
+    file is leased to it for `lease_seconds`: the owner must renew the lease
+    (see LeaseKeeper) or it is handed back to `from_status` once it expires.
+    """
+    value = dict(extra or {})
+    if owner:
+        value.update(_lease_fields(from_status, owner, lease_seconds))
+    try:
+        return _run_set_status(filename, to_status, from_status, value)
+    except Exception as e:
+        logger.error(f"Redis claim_file error: {e}")
+        return False
+
+
+def claim_files(filenames, from_status, to_status, owner, lease_seconds=LEASE_SECONDS):
+    """claim_file() for many files in one round trip; returns the claimed ones."""
+    if not filenames:
+        return []
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for filename in filenames:
+            keys, args = _set_status_call(
+                filename,
+                to_status,
+                from_status,
+                _lease_fields(from_status, owner, lease_seconds),
+            )
+            _set_status_script(keys=keys, args=args, client=pipe)
+        results = pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis claim_files error: {e}")
+        return []
+    return [f for f, (applied, _) in zip(filenames, results) if applied]
 
 
 def get_files_by_status(status):
-    """List all files in Redis with the given status."""
+    """List all files with the given status, oldest transition first."""
     try:
-        all_keys = redis_client.keys("file:*")
+        return redis_client.zrange(f"{STATUS_INDEX_PREFIX}{status}", 0, -1)
     except Exception as e:
         logger.error(f"Redis get_files_by_status error: {e}")
         return []
-    files = []
-    for key in all_keys:
+
+
+def get_status_version():
+    """Counter incremented by every status transition (0 if unavailable)."""
+    try:
+        return int(redis_client.get(STATUS_VERSION_KEY) or 0)
+    except Exception as e:
+        logger.error(f"Redis get_status_version error: {e}")
+        return 0
+
+
+def get_status_counts(statuses):
+    """Return {status: count} for the given statuses in one round trip."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for status in statuses:
+            pipe.zcard(f"{STATUS_INDEX_PREFIX}{status}")
+        return dict(zip(statuses, pipe.execute()))
+    except Exception as e:
+        logger.error(f"Redis get_status_counts error: {e}")
+        return {status: 0 for status in statuses}
+
+
+def _stream_id(entry_id):
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def _stage_stream_positions(batch_size):
+    """{stream: last entry id} of every stage stream."""
+    return {
+        stream: redis_client.xinfo_stream(stream)["last-generated-id"]
+        for stream in redis_client.scan_iter(f"{STAGE_STREAM_PREFIX}*", count=batch_size)
+    }
+
+
+def _replay_stage_events(since, batch_size):
+    """
+    Filenames published to any stage stream after the positions in `since`
+    ({stream: entry id}; streams not in it are read from the start), which
+    are advanced. Raises if a stream was trimmed past its position, since
+    those transitions cannot be replayed.
+    """
+    touched = set()
+    for stream in redis_client.scan_iter(f"{STAGE_STREAM_PREFIX}*", count=batch_size):
+        last = since.get(stream, "0-0")
+        trimmed = redis_client.xinfo_stream(stream).get("max-deleted-entry-id") or "0-0"
+        if _stream_id(trimmed) > _stream_id(last):
+            raise RuntimeError(
+                f"{stream} was trimmed during the index rebuild; run it again when "
+                "the pipeline is quieter (or raise STAGE_STREAM_MAXLEN)"
+            )
+        while True:
+            entries = redis_client.xrange(stream, min=f"({last}", count=batch_size)
+            for entry_id, fields in entries:
+                touched.add(fields.get("filename"))
+                last = entry_id
+            if len(entries) < batch_size:
+                break
+        since[stream] = last
+    touched.discard(None)
+    return touched
+
+
+def rebuild_status_index(batch_size=500, max_attempts=10):
+    """
+    Rebuild every status index set from the existing file:* hashes.
+
+    Used once when migrating an existing Redis, or to repair the index. The new
+    sets are built under temporary keys and renamed into place, so stage loops
+    keep reading the old index until the rebuild is complete.
+
+    Safe while the pipeline runs: the SCAN is not atomic, so every file
+    published to a stage stream since the rebuild started is re-read before
+    the swap, and the swap itself only commits if no transition happened
+    after that replay (WATCH on STATUS_VERSION_KEY, which every transition
+    bumps); otherwise it replays again, up to `max_attempts` times.
+    Returns {status: count}.
+    """
+    tmp_prefix = f"{STATUS_INDEX_PREFIX}rebuild:"
+    for key in redis_client.scan_iter(f"{tmp_prefix}*", count=batch_size):
+        redis_client.delete(key)
+    since = _stage_stream_positions(batch_size)
+
+    def index(keys, replace=False):
+        """Add files to the temporary sets (`replace`: drop them from any other first)."""
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, "status", "updated_at")
+        rows = pipe.execute()
+        stale = list(redis_client.scan_iter(f"{tmp_prefix}*", count=batch_size)) if replace else []
+        pipe = redis_client.pipeline(transaction=False)
+        for key, (status, updated_at) in zip(keys, rows):
+            filename = key[len("file:"):]
+            for tmp_key in stale:
+                pipe.zrem(tmp_key, filename)
+            if status:
+                pipe.zadd(f"{tmp_prefix}{status}", {filename: float(updated_at or 0)})
+        pipe.execute()
+
+    batch = []
+    for key in redis_client.scan_iter("file:*", count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            index(batch)
+            batch = []
+    if batch:
+        index(batch)
+
+    for _ in range(max_attempts):
+        with redis_client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(STATUS_VERSION_KEY)
+                touched = sorted(_replay_stage_events(since, batch_size))
+                for i in range(0, len(touched), batch_size):
+                    index([f"file:{f}" for f in touched[i:i + batch_size]], replace=True)
+                live, rebuilt = [], []
+                for key in redis_client.scan_iter(f"{STATUS_INDEX_PREFIX}*", count=batch_size):
+                    (rebuilt if key.startswith(tmp_prefix) else live).append(key)
+                counts = {key[len(tmp_prefix):]: redis_client.zcard(key) for key in rebuilt}
+                pipe.multi()
+                for key in live:
+                    pipe.delete(key)
+                for status in counts:
+                    pipe.rename(f"{tmp_prefix}{status}", f"{STATUS_INDEX_PREFIX}{status}")
+                pipe.execute()
+                return counts
+            except redis.WatchError:
+                logger.info("Status changed during the index swap; replaying again")
+    raise RuntimeError(
+        f"Status index rebuild kept racing live transitions ({max_attempts} attempts)"
+    )
+
+
+def ensure_stage_group(status, group):
+    """Create the consumer group for a status stream if it does not exist yet."""
+    try:
+        redis_client.xgroup_create(
+            f"{STAGE_STREAM_PREFIX}{status}", group, id="0", mkstream=True
+        )
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _read_stage_entries(stream, group, consumer, count, block_ms, reclaim_idle_ms):
+    """Reclaim stale pending entries first, otherwise block for new ones."""
+    claimed = redis_client.xautoclaim(
+        stream, group, consumer, min_idle_time=reclaim_idle_ms, start_id="0-0", count=count
+    )
+    entries = claimed[1] if claimed else []
+    if entries:
+        logger.info(f"Reclaimed {len(entries)} stale pending entries from {stream}")
+        return entries
+    resp = redis_client.xreadgroup(
+        group, consumer, {stream: ">"}, count=count, block=block_ms
+    )
+    return resp[0][1] if resp else []
+
+
+def iter_stage_files(
+    status,
+    group,
+    claim_status=None,
+    consumer=CONSUMER_NAME,
+    count=10,
+    block_ms=STAGE_BLOCK_MS,
+    reclaim_idle_ms=STAGE_RECLAIM_IDLE_MS,
+):
+    """
+    Yield filenames that entered `status`, forever, for the stage `group`.
+
+    - Files already sitting in `status` (from before this consumer started) are
+      yielded first from the status index.
+    - After that, blocks on XREADGROUP; entries left pending by a crashed
+      consumer are reclaimed once idle for `reclaim_idle_ms`.
+    - An entry is acknowledged when the caller asks for the next file, i.e.
+      only after the loop body for it has finished.
+    - Events for files whose current status has since moved on are acked and
+      skipped, so duplicate or stale events are harmless.
+    - Retries this stage scheduled (see handle_auto_retry) are moved back to
+      `status` once due, which publishes a fresh event for them.
+    - With `claim_status`, each file is first claimed (moved to `claim_status`
+      under a lease held by this process until the caller asks for the next
+      file), so several replicas of a stage never process the same file. The
+      caller's guarded writes use lease_keeper.token(filename) as owner.
+      Expired leases are handed back to their stage from here as well.
+    """
+    stream = f"{STAGE_STREAM_PREFIX}{status}"
+    ensure_stage_group(status, group)
+
+    def still_in_status(filename):
         try:
-            val = redis_client.hgetall(key)
-            if val.get("status") == status:
-                files.append(key.replace("file:", ""))
-        except Exception:
+            return redis_client.hget(f"file:{filename}", "status") == status
+        except Exception as e:
+            logger.error(f"Redis stage status check error: {e}")
+            return True
+
+    def deliver(filename):
+        token = None
+        if claim_status:
+            token = lease_keeper.claim(filename, status, claim_status)
+            if not token:
+                return
+        elif still_in_status(filename):
+            mark_stage_started([filename])
+        else:
+            return
+        try:
+            yield filename
+        finally:
+            # A lease the caller took itself is the caller's to release.
+            if token:
+                lease_keeper.release(filename, token=token)
+        worker_monitor.beat()
+
+    for filename in get_files_by_status(status):
+        yield from deliver(filename)
+    while True:
+        worker_monitor.beat()
+        promote_due_retries(group, status)
+        reclaim_expired_leases()
+        try:
+            entries = _read_stage_entries(
+                stream, group, consumer, count, block_ms, reclaim_idle_ms
+            )
+        except Exception as e:
+            logger.error(f"Redis stage stream read error on {stream}: {e}")
+            time.sleep(1)
+            continue
+        for entry_id, fields in entries:
+            filename = (fields or {}).get("filename")
+            if filename:
+                yield from deliver(filename)
+            try:
+                redis_client.xack(stream, group, entry_id)
+            except Exception as e:
+                logger.error(f"Redis stage ack error on {stream}: {e}")
+
+
+def mark_stage_started(filenames):
+    """Record when a stage picked these files up (see STARTED_AT_FIELD)."""
+    try:
+        now = time.time()
+        pipe = redis_client.pipeline(transaction=False)
+        for filename in filenames:
+            pipe.hset(f"file:{filename}", STARTED_AT_FIELD, now)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis mark_stage_started error: {e}")
+
+
+def _filter_in_status(filenames, status):
+    """Drop files whose current status is no longer `status` (one round trip)."""
+    if not filenames:
+        return []
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for filename in filenames:
+            pipe.hget(f"file:{filename}", "status")
+        current = pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis stage status check error: {e}")
+        return list(filenames)
+    return [f for f, s in zip(filenames, current) if s == status]
+
+
+def iter_stage_batches(
+    status,
+    group,
+    batch_size=50,
+    claim_status=None,
+    consumer=CONSUMER_NAME,
+    block_ms=STAGE_BLOCK_MS,
+    reclaim_idle_ms=STAGE_RECLAIM_IDLE_MS,
+):
+    """
+    Like iter_stage_files(), but yields lists of up to `batch_size` filenames.
+
+    A batch's stream entries are acknowledged (and its leases released, with
+    `claim_status`) together when the caller asks for the next batch.
+    """
+    stream = f"{STAGE_STREAM_PREFIX}{status}"
+    ensure_stage_group(status, group)
+
+    def deliver(filenames):
+        if claim_status:
+            batch = lease_keeper.claim_many(filenames, status, claim_status)
+            token = lease_keeper.token(batch[0]) if batch else None
+        else:
+            batch = _filter_in_status(filenames, status)
+            token = None
+            if batch:
+                mark_stage_started(batch)
+        if not batch:
+            return
+        try:
+            yield batch
+        finally:
+            if token:
+                lease_keeper.release(*batch, token=token)
+        worker_monitor.beat()
+
+    backlog = get_files_by_status(status)
+    for i in range(0, len(backlog), batch_size):
+        yield from deliver(backlog[i:i + batch_size])
+    while True:
+        worker_monitor.beat()
+        promote_due_retries(group, status)
+        reclaim_expired_leases()
+        try:
+            entries = _read_stage_entries(
+                stream, group, consumer, batch_size, block_ms, reclaim_idle_ms
+            )
+        except Exception as e:
+            logger.error(f"Redis stage stream read error on {stream}: {e}")
+            time.sleep(1)
+            continue
+        if not entries:
             continue
-    return files
+        names = []
+        for _, fields in entries:
+            filename = (fields or {}).get("filename")
+            if filename and filename not in names:
+                names.append(filename)
+        yield from deliver(names)
+        try:
+            redis_client.xack(stream, group, *[entry_id for entry_id, _ in entries])
+        except Exception as e:
+            logger.error(f"Redis stage ack error on {stream}: {e}")
 
 
-def set_file_error(filename, error):
-    """Set status to error, attach error details."""
-    set_file_status(filename, "error", error=error)
+def set_file_error(filename, error, retry_stage=None, owner=None):
+    """
+    Set status to error, attach error details.
+
+    With `retry_stage`, that stage's retry counter is incremented in the same
+    round trip; the new count is returned (None otherwise or on failure).
+    `owner` guards the write as in set_file_status(); the counter then
+    follows in a second round trip, only if the write applied.
+    """
+    try:
+        if owner:
+            if not _run_set_status(filename, "error", None, {"error": error}, owner=owner):
+                logger.warning(f"Not marking {filename} as error: lease lost by {owner}")
+                return None
+            return redis_client.incr(retry_key(retry_stage, filename)) if retry_stage else None
+        pipe = redis_client.pipeline(transaction=False)
+        keys, args = _set_status_call(filename, "error", None, {"error": error})
+        _set_status_script(keys=keys, args=args, client=pipe)
+        if retry_stage:
+            pipe.incr(retry_key(retry_stage, filename))
+        results = pipe.execute()
+        return results[1] if retry_stage else None
+    except Exception as e:
+        logger.error(f"Redis set_file_error error: {e}")
+        return None
 
 
 def clear_file_error(filename):
-    """Remove error status from file (set to queued, clear retries)."""
-    key = f"file:{filename}"
+    """Remove error status from file (set to queued, clear retries).
+
+    The file starts over, so a preview cycle it was in is dropped too (its
+    full stems must not be packaged as a preview, nor stay deprioritized).
+
+    Dropping the error, the retry counters and the status write are one
+    atomic script call.
+    """
     try:
-        redis_client.hset(key, "status", "queued")
-        for stage in ["metadata", "splitter", "packager", "organizer"]:
-            redis_client.delete(f"{stage}_retries:{filename}")
-        redis_client.hdel(key, "error")
+        _run_set_status(
+            filename,
+            "queued",
+            None,
+            {},
+            delete_keys=_retry_keys(RETRY_STAGES, filename),
+            remove_fields=("error", *PREVIEW_CYCLE_FIELDS),
+        )
     except Exception as e:
         logger.error(f"Redis clear_file_error error: {e}")
 
+
+# -------- JOB LEASES --------
+
+
+# Extends a lease, but only for its current owner and only before it expired:
+# once a lease ran out, reclaim_expired_leases() may hand the file to someone
+# else at any moment, so the old owner must not revive it.
+# KEYS[1] = file hash; ARGV = filename, owner, now, new expiry. Returns 0/1.
+_RENEW_LEASE_LUA = """
+local lease = redis.call('HMGET', KEYS[1], '""" + LEASE_OWNER_FIELD + """', '""" + LEASE_EXPIRES_FIELD + """')
+if lease[1] ~= ARGV[2] or not lease[2] or tonumber(lease[2]) <= tonumber(ARGV[3]) then
+  return 0
+end
+redis.call('HSET', KEYS[1], '""" + LEASE_EXPIRES_FIELD + """', ARGV[4])
+redis.call('ZADD', '""" + LEASES_KEY + """', ARGV[4], ARGV[1])
+return 1
+"""
+_renew_lease_script = redis_client.register_script(_RENEW_LEASE_LUA)
+
+# Drops a LEASES_KEY entry whose file no longer carries a lease (e.g. the
+# file:* hash was deleted). KEYS[1] = file hash; ARGV[1] = filename.
+_DROP_STALE_LEASE_LUA = """
+if redis.call('HEXISTS', KEYS[1], '""" + LEASE_OWNER_FIELD + """') == 0 then
+  return redis.call('ZREM', '""" + LEASES_KEY + """', ARGV[1])
+end
+return 0
+"""
+_drop_stale_lease_script = redis_client.register_script(_DROP_STALE_LEASE_LUA)
+
+
+def renew_leases(leases, lease_seconds=LEASE_SECONDS):
+    """
+    Extend leases ({filename: owner token}) in one round trip; returns the
+    renewed files (None on error).
+    """
+    if not leases:
+        return []
+    now = time.time()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for filename, owner in leases.items():
+            _renew_lease_script(
+                keys=[f"file:{filename}"],
+                args=[filename, owner, now, now + lease_seconds],
+                client=pipe,
+            )
+        results = pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis renew_leases error: {e}")
+        return None
+    return [f for f, renewed in zip(leases, results) if renewed]
+
+
+def reclaim_expired_leases(limit=100, max_retries=MAX_RETRIES):
+    """
+    Hand files whose lease expired (their worker died or hung) back to the
+    status they were claimed from, which re-publishes them to that stage.
+
+    Each reclaim counts as a failed attempt of that stage; once a file used
+    up `max_retries` it is moved to error instead, so a job that reliably
+    crashes its worker is not handed out forever.
+
+    Safe to call from every replica: each hand-back is guarded by the file's
+    status and the expired owner, so it happens at most once per lease.
+    """
+    try:
+        expired = redis_client.zrangebyscore(LEASES_KEY, "-inf", time.time(), start=0, num=limit)
+        if not expired:
+            return []
+        pipe = redis_client.pipeline(transaction=False)
+        for filename in expired:
+            pipe.hmget(f"file:{filename}", "status", LEASE_OWNER_FIELD, LEASE_FROM_FIELD)
+        records = pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis reclaim_expired_leases error: {e}")
+        return []
+    reclaimed = []
+    for filename, (status, owner, from_status) in zip(expired, records):
+        try:
+            if not (owner and from_status):
+                _drop_stale_lease_script(keys=[f"file:{filename}"], args=[filename])
+                continue
+            stage = STATUS_STAGES.get(from_status)
+            attempts = get_retry_count(stage, filename) + 1 if stage else 0
+            if attempts >= max_retries:
+                error = (
+                    f"{datetime.datetime.now().isoformat()}\nLease of {owner} expired in "
+                    f"{status} (attempt {attempts}); the worker died or hung"
+                )
+                if _run_set_status(filename, "error", status, {"error": error}, owner=owner):
+                    redis_client.incr(retry_key(stage, filename))
+                    logger.error(f"Lease on {filename} expired {attempts} times in {status}; marked as error")
+                    notify_all(
+                        f"Pipeline Error [{stage}]",
+                        f"❌ {stage.capitalize()} FAILED for {filename}: worker lost it {attempts} times",
+                    )
+            elif _run_set_status(filename, from_status, status, {}, owner=owner):
+                if stage:
+                    redis_client.incr(retry_key(stage, filename))
+                logger.warning(
+                    f"Lease of {owner} on {filename} expired in {status}; back to {from_status}"
+                )
+                reclaimed.append(filename)
+        except Exception as e:
+            logger.error(f"Redis reclaim_expired_leases error: {e}")
+    return reclaimed
+
+
+class LeaseKeeper:
+    """
+    Claims jobs for this process and keeps their leases alive.
+
+    Every claim gets its own owner token (see token()), which the job passes
+    to its guarded status writes. A background thread renews every held
+    lease each third of the lease period until the job is released. A lease
+    that cannot be renewed (the job already left the claimed status, or it
+    expired and was reclaimed) is no longer renewed; the job's final status
+    write, guarded by its token, then tells the worker whether its result
+    still counts.
+    """
+
+    def __init__(self, owner=LEASE_OWNER, lease_seconds=LEASE_SECONDS):
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._tokens = {}
+        self._lost = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def new_token(self):
+        return f"{self.owner}:{uuid.uuid4().hex[:12]}"
+
+    def claim(self, filename, from_status, to_status, extra=None):
+        """claim_file() under a new token; returns the token if the job is ours, else None."""
+        token = self.new_token()
+        if not claim_file(
+            filename, from_status, to_status, extra, token, self.lease_seconds
+        ):
+            return None
+        self._hold([filename], token)
+        return token
+
+    def claim_many(self, filenames, from_status, to_status):
+        """claim_files() under one new token; returns the claimed files."""
+        token = self.new_token()
+        claimed = claim_files(filenames, from_status, to_status, token, self.lease_seconds)
+        self._hold(claimed, token)
+        return claimed
+
+    def token(self, filename):
+        """
+        Owner token of this process's claim on `filename`, for guarded status
+        writes. Unclaimed files get a token no lease carries, so such writes
+        are rejected rather than applied unguarded.
+        """
+        with self._lock:
+            return self._tokens.get(filename) or f"{self.owner}:unclaimed"
+
+    def release(self, *filenames, token=None):
+        """
+        Stop renewing; the job's status write has already ended the lease.
+        With `token`, only that claim is released, not a later one.
+        """
+        with self._lock:
+            for filename in filenames:
+                if token is None or self._tokens.get(filename) == token:
+                    self._tokens.pop(filename, None)
+                    self._lost.discard(filename)
+
+    def held(self):
+        """{filename: token} of the leases still being renewed."""
+        with self._lock:
+            return {f: t for f, t in self._tokens.items() if f not in self._lost}
+
+    def renew(self):
+        held = self.held()
+        renewed = renew_leases(held, self.lease_seconds)
+        if renewed is None:
+            return  # Redis unavailable; try again next round
+        lost = set(held) - set(renewed)
+        if lost:
+            logger.info(f"No longer holding leases on {sorted(lost)}")
+            with self._lock:
+                # Keep the tokens until release: the job's guarded write
+                # must still fail rather than go through unguarded.
+                self._lost.update(f for f in lost if self._tokens.get(f) == held[f])
+
+    def _hold(self, filenames, token):
+        if not filenames:
+            return
+        with self._lock:
+            for filename in filenames:
+                self._tokens[filename] = token
+                self._lost.discard(filename)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name="lease-keeper"
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self.renew()
+            except Exception as e:
+                logger.warning(f"Lease renewal error: {e}")
+
+
+# One lease keeper per service process.
+lease_keeper = LeaseKeeper()
+
+
+# -------- JOB SCHEDULING --------
+
+
+# Where a file entered the pipeline, and the priority class that implies
+# (lower runs first). The source is recorded on the file hash when it is
+# queued; a "priority" field is only ever set explicitly (per-file override,
+# e.g. a preview's full separation) and wins over the source's default. The
+# preview override lasts one cycle (see PREVIEW_CYCLE_FIELDS), after which
+# the source decides again.
+SOURCE_FIELD = "source"
+PRIORITY_FIELD = "priority"
+DURATION_FIELD = "duration"
+SOURCE_PRIORITIES = {"bot": 0, "watcher": 1, "bulk": 2}
+DEFAULT_SOURCE = "watcher"
+# Assumed length of a job whose duration is unknown (e.g. queued before it
+# was recorded).
+DEFAULT_JOB_SECONDS = 300
+
+
+def input_source(path, input_dir=INPUT_DIR):
+    """Source of a dropped file, from its top-level INPUT_DIR subdirectory."""
+    top = os.path.relpath(path, input_dir).split(os.sep)[0]
+    return {BOT_INPUT_SUBDIR: "bot", BULK_INPUT_SUBDIR: "bulk"}.get(top, DEFAULT_SOURCE)
+
+
+def source_priority(source):
+    return SOURCE_PRIORITIES.get(source, SOURCE_PRIORITIES[DEFAULT_SOURCE])
+
+
+def source_fields(source):
+    """Hash fields recording a file's source (its priority class follows from it)."""
+    return {SOURCE_FIELD: source}
+
+
+def schedule_key(priority, duration, waited):
+    """
+    Sort key: effective priority class first, shortest job first within a
+    class. Waiting lowers the effective class (one per SCHEDULER_AGING_SECONDS)
+    so long or low-priority jobs cannot starve; duration never crosses classes.
+    """
+    return (effective_priority(priority, waited), duration, -waited)
+
+
+def effective_priority(priority, waited):
+    if SCHEDULER_AGING_SECONDS <= 0:
+        return priority
+    return priority - int(waited // SCHEDULER_AGING_SECONDS)
+
+
+def get_scheduled_queue(status):
+    """
+    Files in `status` in the order a scheduled stage will take them, with
+    their source, priority, effective (aged) priority, duration and wait so far.
+
+    Waiting time counts from when the file entered `status` (its score in the
+    status index). One ZRANGE plus one pipelined round trip.
+    """
+    try:
+        entries = redis_client.zrange(f"{STATUS_INDEX_PREFIX}{status}", 0, -1, withscores=True)
+        pipe = redis_client.pipeline(transaction=False)
+        for filename, _ in entries:
+            pipe.hmget(f"file:{filename}", SOURCE_FIELD, PRIORITY_FIELD, DURATION_FIELD)
+        rows = pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis get_scheduled_queue error: {e}")
+        return []
+    now = time.time()
+    ranked = []
+    for (filename, entered), (source, priority, duration) in zip(entries, rows):
+        source = source or DEFAULT_SOURCE
+        priority = int(priority) if priority else source_priority(source)
+        duration = float(duration) if duration else None
+        waited = max(now - entered, 0.0)
+        key = schedule_key(
+            priority, DEFAULT_JOB_SECONDS if duration is None else duration, waited
+        )
+        job = {
+            "filename": filename,
+            "source": source,
+            "priority": priority,
+            "effective_priority": key[0],
+            "duration": duration,
+            "waited_seconds": round(waited, 3),
+        }
+        ranked.append((key, filename, job))
+    ranked.sort(key=lambda item: item[:2])
+    return [job for _, _, job in ranked]
+
+
+def iter_scheduled_files(
+    status, group, claim_status, consumer=CONSUMER_NAME, block_ms=STAGE_BLOCK_MS
+):
+    """
+    Like iter_stage_files(status, group, claim_status), but hands out files in
+    schedule order (see get_scheduled_queue) instead of arrival order.
+
+    The queue is re-ranked every time the caller asks for the next file, so
+    work that arrived meanwhile competes straight away. The stage stream only
+    wakes the loop up while the queue is empty; its entries are acknowledged
+    as soon as they are read, the status index being the source of truth.
+    """
+    stream = f"{STAGE_STREAM_PREFIX}{status}"
+    ensure_stage_group(status, group)
+    while True:
+        worker_monitor.beat()
+        promote_due_retries(group, status)
+        reclaim_expired_leases()
+        claimed = token = None
+        for job in get_scheduled_queue(status):
+            token = lease_keeper.claim(job["filename"], status, claim_status)
+            if token:
+                claimed = job["filename"]
+                break
+        if claimed:
+            logger.info(
+                f"Scheduled {claimed} (priority {job['priority']}, "
+                f"effective {job['effective_priority']}, duration {job['duration']})"
+            )
+            try:
+                yield claimed
+            finally:
+                lease_keeper.release(claimed, token=token)
+            continue
+        try:
+            resp = redis_client.xreadgroup(group, consumer, {stream: ">"}, count=100, block=block_ms)
+            entry_ids = [entry_id for entry_id, _ in resp[0][1]] if resp else []
+            if entry_ids:
+                redis_client.xack(stream, group, *entry_ids)
+        except Exception as e:
+            logger.error(f"Redis stage stream read error on {stream}: {e}")
+            time.sleep(1)
+
+
+# -------- PREVIEWS --------
+
+
+# Files from PREVIEW_SOURCES first go through the pipeline as a preview: the
+# splitter writes PREVIEW_STEM_FILE (no model) and moves the file to "split"
+# with PREVIEW_FIELD = "split"; the packager turns that into
+# <song>_preview_karaoke.mp3, sets PREVIEW_FIELD = "packaged" and sends the
+# file back to metadata_extracted at PREVIEW_FULL_PRIORITY. The full result,
+# packaged as usual, replaces the preview. The full split, re-queuing the
+# file and resetting it from error all drop PREVIEW_CYCLE_FIELDS, so a file
+# dropped again gets a new preview at its source's priority, and full stems
+# never go down the preview path.
+PREVIEW_FIELD = "preview"
+PREVIEW_CYCLE_FIELDS = (PREVIEW_FIELD, PRIORITY_FIELD)
+PREVIEW_STEM_FILE = "preview.wav"
+PREVIEW_SUFFIX = "_preview_karaoke.mp3"
+
+
+def wants_preview(record):
+    """True for a file hash that should get a preview and has none yet."""
+    return record.get(SOURCE_FIELD, DEFAULT_SOURCE) in PREVIEW_SOURCES and not record.get(PREVIEW_FIELD)
+
+
+# -------- SERVICE METRICS --------
+
+
+# Per-service counters/gauges live in "metrics:<service>" hashes so status-api can
+# expose them on /metrics. Field names may carry Prometheus labels, e.g.
+# 'engine_info{engine="inprocess"}'.
+METRICS_PREFIX = "metrics:"
+
+
+def incr_metric(service, name, amount=1):
+    """Add `amount` to a service counter."""
+    try:
+        redis_client.hincrbyfloat(f"{METRICS_PREFIX}{service}", name, amount)
+    except Exception as e:
+        logger.error(f"Redis incr_metric error: {e}")
+
+
+def set_metric(service, name, value):
+    """Set a service gauge to `value`."""
+    try:
+        redis_client.hset(f"{METRICS_PREFIX}{service}", name, value)
+    except Exception as e:
+        logger.error(f"Redis set_metric error: {e}")
+
+
+def get_service_metrics(services):
+    """Return {service: {metric: value}} for the given services in one round trip."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for service in services:
+            pipe.hgetall(f"{METRICS_PREFIX}{service}")
+        return dict(zip(services, pipe.execute()))
+    except Exception as e:
+        logger.error(f"Redis get_service_metrics error: {e}")
+        return {service: {} for service in services}
+
+
+def get_transition_stats():
+    """
+    Return (transitions, histograms) as maintained by the status script.
+
+    transitions: {(from, to): count}
+    histograms: {name: {status: {"buckets": [(le, cumulative count)],
+                                 "sum": float, "count": int}}}
+    """
+    names = (QUEUE_WAIT_HISTOGRAM, PROCESSING_HISTOGRAM)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(TRANSITIONS_KEY)
+        for name in names:
+            pipe.hgetall(f"{HISTOGRAM_PREFIX}{name}")
+        raw_transitions, *raw_histograms = pipe.execute()
+    except Exception as e:
+        logger.error(f"Redis get_transition_stats error: {e}")
+        return {}, {}
+
+    transitions = {}
+    for field, count in raw_transitions.items():
+        prev, _, status = field.partition(">")
+        transitions[(prev, status)] = int(count)
+
+    bounds = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+    histograms = {}
+    for name, raw in zip(names, raw_histograms):
+        per_status = {}
+        for field, value in raw.items():
+            status, _, part = field.rpartition("|")
+            per_status.setdefault(status, {})[part] = value
+        histograms[name] = {}
+        for status, parts in sorted(per_status.items()):
+            cumulative = 0
+            buckets = []
+            for le in bounds:
+                cumulative += int(parts.get(le, 0))
+                buckets.append((le, cumulative))
+            histograms[name][status] = {
+                "buckets": buckets,
+                "sum": float(parts.get("sum", 0)),
+                "count": int(parts.get("count", 0)),
+            }
+    return transitions, histograms
+
+
+# -------- SONG METADATA --------
+
+
+# Metadata is stored as JSON in the "metadata" field of the file:<name> hash, so
+# it is written with the status transition and read back with the status.
+METADATA_FIELD = "metadata"
+METADATA_DEFAULTS = {
+    "TIT2": "Unknown Title",
+    "TPE1": "Unknown Artist",
+    "TALB": "Unknown Album",
+}
+
+
+def metadata_sidecar_path(filename):
+    return os.path.join(META_DIR, f"{os.path.splitext(filename)[0]}.mp3.json")
+
+
+def read_metadata_sidecar(filename):
+    """Return the JSON sidecar for a file (e.g. written by the bot), or None."""
+    path = metadata_sidecar_path(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Metadata JSON error in {path}: {e}")
+        return None
+
+
+def write_metadata_sidecar(filename, meta):
+    os.makedirs(META_DIR, exist_ok=True)
+    path = metadata_sidecar_path(filename)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return path
+
+
+def decode_metadata(raw):
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def set_files_metadata(entries, status="metadata_extracted", reset_retries=None, owner=None):
+    """
+    Store metadata for many files and move them to `status` in one round trip.
+
+    `entries` is [(filename, meta, extra)]; `extra` holds additional hash
+    fields (e.g. duration). `reset_retries` clears those stages' retry counters
+    in the same round trip; `owner` is the lease guard of set_file_status().
+    """
+    updates = []
+    for filename, meta, extra in entries:
+        fields = dict(extra or {})
+        fields[METADATA_FIELD] = json.dumps(meta)
+        updates.append((filename, status, fields))
+    set_file_statuses(updates, reset_retries, owner)
+    if META_JSON_EXPORT:
+        for filename, meta, _ in entries:
+            write_metadata_sidecar(filename, meta)
+
+
+def set_file_metadata(
+    filename, meta, status="metadata_extracted", extra=None, reset_retries=None, owner=None
+):
+    """Store metadata and move the file to `status` in one atomic write."""
+    set_files_metadata([(filename, meta, extra)], status, reset_retries, owner)
+
+
+# Overlays ARGV field/value pairs on a file's stored metadata, in place, so
+# a choice made after extraction (e.g. in the Telegram bot) wins over the
+# tags, and bumps the status version so cached /status responses refresh.
+# Only files the pipeline already knows are touched; for the others the
+# extractor picks the choice up from the JSON sidecar.
+# KEYS[1] = file hash. Returns 0/1.
+_MERGE_METADATA_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+local meta = {}
+local raw = redis.call('HGET', KEYS[1], '""" + METADATA_FIELD + """')
+if raw then
+  local ok, decoded = pcall(cjson.decode, raw)
+  if ok and type(decoded) == 'table' then
+    meta = decoded
+  end
+end
+for i = 1, #ARGV, 2 do
+  meta[ARGV[i]] = ARGV[i + 1]
+end
+redis.call('HSET', KEYS[1], '""" + METADATA_FIELD + """', cjson.encode(meta))
+redis.call('INCR', '""" + STATUS_VERSION_KEY + """')
+return 1
+"""
+_merge_metadata_script = redis_client.register_script(_MERGE_METADATA_LUA)
+
+
+def merge_file_metadata(filename, meta):
+    """
+    Overlay the non-empty fields of `meta` on a file's stored metadata in one
+    atomic write; returns whether the file had a record to merge into.
+    """
+    args = []
+    for key, value in meta.items():
+        if value:
+            args.extend([key, value])
+    if not args:
+        return False
+    try:
+        return bool(_merge_metadata_script(keys=[f"file:{filename}"], args=args))
+    except Exception as e:
+        logger.error(f"Redis merge_file_metadata error: {e}")
+        return False
+
+
+def get_file_metadata(filename):
+    """Return a file's metadata from Redis, falling back to its JSON sidecar, or None."""
+    try:
+        meta = decode_metadata(redis_client.hget(f"file:{filename}", METADATA_FIELD))
+        if meta is not None:
+            return meta
+    except Exception as e:
+        logger.error(f"Redis get_file_metadata error: {e}")
+    return read_metadata_sidecar(filename)
+
+
+def with_metadata_defaults(meta):
+    """Copy of `meta` with missing or empty TIT2/TPE1/TALB filled in."""
+    meta = dict(meta or {})
+    for key, value in METADATA_DEFAULTS.items():
+        if not meta.get(key):
+            meta[key] = value
+    return meta
+
+
 # -------- HARDENED NOTIFICATIONS --------
 
 
+# Reused across messages: one pooled HTTP session and one SMTP connection,
+# both only used from the dispatcher thread (guarded anyway for direct calls).
+_http_session = requests.Session()
+_smtp_conn = None
+_smtp_lock = threading.Lock()
+
+
+# Telegram rejects sendMessage texts longer than this.
+TELEGRAM_MAX_MESSAGE = 4096
+# Per-notification line length in a digest.
+DIGEST_LINE_CHARS = 200
+
+
+def truncate_text(text, limit):
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
 def send_telegram_message(message):
     if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
         url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
+        data = {"chat_id": TELEGRAM_CHAT_ID, "text": truncate_text(message, TELEGRAM_MAX_MESSAGE)}
         try:
-            resp = requests.post(url, data=data, timeout=5)
+            resp = _http_session.post(url, data=data, timeout=5)
             if not resp.ok:
                 logger.warning(f"Telegram notification failed: {resp.text}")
         except Exception as e:
@@ -137,10 +1537,32 @@ def send_telegram_message(message):
         logger.info("Telegram notification skipped: TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID not set.")
 
 
+def send_telegram_audio(path, caption=""):
+    """Upload an audio file to the notification chat; returns True if sent."""
+    if not (TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID):
+        logger.info("Telegram audio skipped: TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID not set.")
+        return False
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendAudio"
+    try:
+        with open(path, "rb") as f:
+            resp = _http_session.post(
+                url,
+                data={"chat_id": TELEGRAM_CHAT_ID, "caption": caption},
+                files={"audio": f},
+                timeout=60,
+            )
+        if not resp.ok:
+            logger.warning(f"Telegram audio upload failed: {resp.text}")
+        return resp.ok
+    except Exception as e:
+        logger.warning(f"Telegram audio upload error: {e}")
+        return False
+
+
 def send_slack_message(message):
     if SLACK_WEBHOOK_URL:
         try:
-            resp = requests.post(SLACK_WEBHOOK_URL, json={"text": message}, timeout=5)
+            resp = _http_session.post(SLACK_WEBHOOK_URL, json={"text": message}, timeout=5)
             if not resp.ok:
                 logger.warning(f"Slack notification failed: {resp.text}")
         except Exception as e:
@@ -149,106 +1571,383 @@ def send_slack_message(message):
         logger.info("Slack notification skipped: SLACK_WEBHOOK_URL not set.")
 
 
+def _smtp_connection():
+    global _smtp_conn
+    if _smtp_conn is None:
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+        server.starttls()
+        server.login(SMTP_USERNAME, SMTP_PASSWORD)
+        _smtp_conn = server
+    return _smtp_conn
+
+
+def _close_smtp():
+    global _smtp_conn
+    if _smtp_conn is not None:
+        try:
+            _smtp_conn.quit()
+        except Exception:
+            pass
+        _smtp_conn = None
+
+
 def send_email(subject, message):
     if NOTIFY_EMAILS and SMTP_SERVER and SMTP_USERNAME and SMTP_PASSWORD:
-        try:
-            msg = EmailMessage()
-            msg.set_content(message)
-            msg["Subject"] = subject
-            msg["From"] = SMTP_USERNAME
-            msg["To"] = [e.strip() for e in NOTIFY_EMAILS.split(",")]
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                server.starttls()
-                server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                server.send_message(msg)
-        except Exception as e:
-            logger.warning(f"Email notification error: {e}")
+        msg = EmailMessage()
+        msg.set_content(message)
+        msg["Subject"] = subject
+        msg["From"] = SMTP_USERNAME
+        msg["To"] = [e.strip() for e in NOTIFY_EMAILS.split(",")]
+        with _smtp_lock:
+            # The server may have dropped an idle connection: reconnect once.
+            for attempt in range(2):
+                try:
+                    _smtp_connection().send_message(msg)
+                    return
+                except Exception as e:
+                    _close_smtp()
+                    if attempt:
+                        logger.warning(f"Email notification error: {e}")
     else:
         logger.info("Email notification skipped: NOTIFY_EMAILS or SMTP config not set.")
 
 
-def notify_all(subject, message):
+def deliver_notification(subject, message):
+    """Send one notification to every configured channel, synchronously."""
     send_telegram_message(message)
     send_slack_message(message)
     send_email(subject, message)
 
+
+class NotificationDispatcher:
+    """
+    Delivers notifications from a background thread so stage loops never wait
+    on Telegram/Slack/SMTP.
+
+    Sends are spaced by the rate limit; whatever queued up meanwhile (or within
+    the digest window, when enabled) is coalesced into a single digest message.
+    When the queue is full new notifications are dropped and logged.
+    """
+
+    def __init__(
+        self,
+        rate_per_minute=NOTIFY_RATE_PER_MINUTE,
+        digest_seconds=NOTIFY_DIGEST_SECONDS,
+        max_queue=NOTIFY_QUEUE_SIZE,
+        deliver=deliver_notification,
+    ):
+        self.min_interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.digest_seconds = digest_seconds
+        self.deliver = deliver
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._next_send = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, subject, message):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((subject, message))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Notification queue full, dropped: {subject}")
+
+    def flush(self, timeout=30):
+        """Wait (up to `timeout`) until everything queued has been delivered."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name="notification-dispatcher"
+                )
+                self._thread.start()
+
+    def _drain(self, batch, until):
+        """Add queued notifications to `batch`, waiting for more until `until`."""
+        while True:
+            remaining = until - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            self._drain(batch, time.monotonic() + self.digest_seconds)
+            # Rate limit: collect whatever arrives while we wait for our slot.
+            self._drain(batch, self._next_send)
+            try:
+                self._send(batch)
+            except Exception as e:
+                logger.warning(f"Notification dispatch error: {e}")
+            finally:
+                self._next_send = time.monotonic() + self.min_interval
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send(self, batch):
+        if len(batch) == 1:
+            self.deliver(*batch[0])
+            return
+        subject = f"Karaoke Pipeline Digest ({len(batch)} notifications)"
+        self.deliver(subject, digest_body(batch))
+
+
+def digest_body(batch, limit=TELEGRAM_MAX_MESSAGE):
+    """
+    Summary of many notifications that fits in one Telegram message: counts
+    per subject, then the first line of each message (truncated), as many as
+    fit in `limit` characters.
+    """
+    counts = collections.Counter(subject for subject, _ in batch)
+    lines = [f"{count} × {subject}" for subject, count in counts.most_common()]
+    lines.append("")
+    size = sum(len(line) + 1 for line in lines)
+    for shown, (_, message) in enumerate(batch):
+        first = message.strip().split("\n", 1)[0]
+        line = truncate_text(first, DIGEST_LINE_CHARS)
+        more = f"… and {len(batch) - shown} more"
+        if size + len(line) + 1 + len(more) > limit:
+            lines.append(more)
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+notification_dispatcher = NotificationDispatcher()
+# Short-lived scripts (e.g. maintenance) get their queued notifications out.
+atexit.register(notification_dispatcher.flush)
+
+
+def notify_all(subject, message):
+    """Queue a notification for every channel; returns immediately."""
+    notification_dispatcher.submit(subject, message)
+
+
+class BackgroundSender:
+    """
+    Runs slow one-off sends (e.g. Telegram audio uploads) on a background
+    thread, one at a time and in order, so workers hand them off and move on.
+    Unlike notifications these are never coalesced; when the queue is full
+    new sends are dropped and logged.
+    """
+
+    def __init__(self, send, max_queue=NOTIFY_QUEUE_SIZE, name="background-sender"):
+        self.send = send
+        self.name = name
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, *args):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(args)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"{self.name} queue full, dropped a send")
+
+    def flush(self, timeout=60):
+        """Wait (up to `timeout`) until everything queued has been sent."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                self.send(*args)
+            except Exception as e:
+                logger.warning(f"{self.name} error: {e}")
+            finally:
+                self._queue.task_done()
+
+
+audio_sender = BackgroundSender(send_telegram_audio, name="telegram-audio")
+atexit.register(audio_sender.flush)
+
+
+def queue_telegram_audio(path, caption=""):
+    """Queue an audio upload to the notification chat; returns immediately."""
+    audio_sender.submit(path, caption)
+
+
 # -------- RETRY UTILITIES --------
 
 
 def get_retry_count(stage, filename):
     """Return the current retry count for this stage/filename."""
     try:
-        return int(redis_client.get(f"{stage}_retries:{filename}") or 0)
+        return int(redis_client.get(retry_key(stage, filename)) or 0)
     except Exception as e:
         logger.error(f"Redis get_retry_count error: {e}")
         return 0
 
 
 def increment_retry(stage, filename):
-    """Increment and return the retry count for this stage/filename."""
-    retries = get_retry_count(stage, filename) + 1
+    """Atomically increment and return the retry count for this stage/filename."""
     try:
-        redis_client.set(f"{stage}_retries:{filename}", retries)
+        return redis_client.incr(retry_key(stage, filename))
     except Exception as e:
         logger.error(f"Redis increment_retry error: {e}")
-    return retries
+        return get_retry_count(stage, filename) + 1
 
 
 def reset_retry(stage, filename):
     """Clear retry counter for stage/filename."""
     try:
-        redis_client.delete(f"{stage}_retries:{filename}")
+        redis_client.delete(retry_key(stage, filename))
     except Exception as e:
         logger.error(f"Redis reset_retry error: {e}")
 
+# -------- DELAYED RETRIES --------
+
+
+# "retry_schedule:<stage>" sorted sets hold files waiting for a retry, scored
+# by the time the retry is due. Meanwhile the file sits in RETRY_STATUS (with
+# its last error), so the stage loop moves straight on to other work.
+RETRY_SCHEDULE_PREFIX = "retry_schedule:"
+RETRY_STATUS = "retry_scheduled"
+
+
+def retry_backoff(attempt, base_delay, max_delay=RETRY_BACKOFF_MAX):
+    """Exponential backoff with jitter: half fixed, half random."""
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def schedule_retry(stage, filename, delay, error, owner=None):
+    """
+    Park a file in RETRY_STATUS and schedule `stage` to retry it in `delay` s.
+
+    Both happen in one status script call, guarded by `owner` as in
+    set_file_status(); returns whether it was applied.
+    """
+    try:
+        keys, args = _set_status_call(
+            filename,
+            RETRY_STATUS,
+            None,
+            {"error": error},
+            owner=owner,
+            schedule=(f"{RETRY_SCHEDULE_PREFIX}{stage}", time.time() + delay),
+        )
+        applied, _ = _set_status_script(keys=keys, args=args)
+    except Exception as e:
+        logger.error(f"Redis schedule_retry error: {e}")
+        return False
+    if not applied:
+        logger.warning(f"Not scheduling a {stage} retry of {filename}: lease lost by {owner}")
+    return bool(applied)
+
+
+def promote_due_retries(stage, status, limit=100):
+    """
+    Move files whose retry is due back to `status` (the stage's input status).
+
+    claim_file() makes this safe with several consumers and skips files that
+    were reset by hand in the meantime; either way the entry is dropped.
+    """
+    key = f"{RETRY_SCHEDULE_PREFIX}{stage}"
+    try:
+        due = redis_client.zrangebyscore(key, "-inf", time.time(), start=0, num=limit)
+    except Exception as e:
+        logger.error(f"Redis promote_due_retries error: {e}")
+        return []
+    promoted = []
+    for filename in due:
+        if claim_file(filename, RETRY_STATUS, status):
+            logger.info(f"Retrying {filename} in {stage}")
+            promoted.append(filename)
+        try:
+            redis_client.zrem(key, filename)
+        except Exception as e:
+            logger.error(f"Redis promote_due_retries error: {e}")
+    return promoted
+
+
 # -------- GENERIC AUTO-RETRY LOGIC --------
 
 
 def handle_auto_retry(
-    stage, filename, func, max_retries=3, retry_delay=5, notify_fail=True
+    stage, filename, func, max_retries=3, retry_delay=5, notify_fail=True, owner=None
 ):
     """
-    Run func(); if it raises, auto-retry up to max_retries.
+    Run func() once; if it raises, schedule a delayed retry instead of sleeping.
     - stage: str, e.g. 'splitter'
     - filename: the file being processed
     - func: callable (should take no arguments)
+    - owner: lease token guarding the failure writes (see set_file_status)
+
+    Failed attempts before the max_retries-th are rescheduled with exponential
+    backoff (see retry_backoff) and return None immediately; the last failure
+    notifies and re-raises so the caller can mark the file as failed.
     """
-    for attempt in range(1, max_retries + 1):
-        try:
-            result = func()
-            reset_retry(stage, filename)
-            return result
-        except Exception as e:
-            retries = increment_retry(stage, filename)
-            tb = traceback.format_exc()
-            timestamp = datetime.datetime.now().isoformat()
-            error_details = (
-                f"{timestamp}\nException: {e} (attempt {retries})\n\nTraceback:\n{tb}"
+    try:
+        result = func()
+        reset_retry(stage, filename)
+        return result
+    except Exception as e:
+        retries = increment_retry(stage, filename)
+        tb = traceback.format_exc()
+        timestamp = datetime.datetime.now().isoformat()
+        error_details = (
+            f"{timestamp}\nException: {e} (attempt {retries})\n\nTraceback:\n{tb}"
+        )
+        logger.error(f"Pipeline {stage} error on {filename}: {e}")
+        if retries < max_retries:
+            delay = retry_backoff(retries, retry_delay)
+            if schedule_retry(stage, filename, delay, error_details, owner=owner):
+                logger.info(f"Scheduled {stage} retry {retries + 1} for {filename} in {delay:.0f}s")
+            return None
+        set_file_error(filename, error_details, owner=owner)
+        if notify_fail:
+            notify_all(
+                f"Pipeline Error [{stage}]",
+                f"❌ {stage.capitalize()} FAILED for {filename} after {max_retries} retries\n\n{e}\n\n{tb}",
             )
-            set_file_error(filename, error_details)
-            logger.error(f"Pipeline {stage} error on {filename}: {e}")
-            if attempt < max_retries:
-                time.sleep(retry_delay)
-            elif notify_fail:
-                notify_all(
-                    f"Pipeline Error [{stage}]",
-                    f"❌ {stage.capitalize()} FAILED for {filename} after {max_retries} retries\n\n{e}\n\n{tb}",
-                )
-            if attempt == max_retries:
-                raise
+        raise
+
 
 # -------- FILE STATUS SUMMARY --------
 
 
+def get_file_records(filenames):
+    """Raw file:<name> hashes for many files in one pipelined round trip."""
+    pipe = redis_client.pipeline(transaction=False)
+    for filename in filenames:
+        pipe.hgetall(f"file:{filename}")
+    return pipe.execute()
+
+
 def get_file_status(filename):
-    """Return status and last error for the given file from Redis."""
-    key = f"file:{filename}"
+    """Return status, last error and metadata for the given file from Redis."""
     try:
-        data = redis_client.hgetall(key)
+        data = get_file_records([filename])[0]
         return {
             "filename": filename,
             "status": data.get("status", "unknown"),
             "last_error": data.get("error", ""),
+            "metadata": decode_metadata(data.get(METADATA_FIELD)),
+            "lease_owner": data.get(LEASE_OWNER_FIELD),
         }
     except Exception as e:
         logger.error(f"Redis get_file_status error: {e}")
@@ -256,11 +1955,156 @@ def get_file_status(filename):
             "filename": filename,
             "status": "unknown",
             "last_error": str(e),
+            "metadata": None,
+            "lease_owner": None,
         }
 
+
+# -------- WORKER HEALTH & PROCESS METRICS --------
+
+
+class WorkerMonitor:
+    """
+    Liveness and local job metrics for one service process.
+
+    Worker loops call beat() every iteration (iter_stage_files does this, also
+    while idle-blocking on the stream); the health endpoint fails when a
+    watched thread died or no beat arrived for `stale_after` seconds.
+    """
+
+    def __init__(self, service="service", stale_after=HEARTBEAT_STALE_SECONDS):
+        self.service = service
+        self.stale_after = stale_after
+        self.started = time.monotonic()
+        self.last_beat = None
+        self.loop_lag = 0.0
+        self.iterations = 0
+        self.jobs_in_flight = 0
+        self.job_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.job_seconds_sum = 0.0
+        self.jobs_total = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def watch(self, thread):
+        self._threads.append(thread)
+
+    def beat(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.last_beat is not None:
+                self.loop_lag = now - self.last_beat
+            self.last_beat = now
+            self.iterations += 1
+
+    def job_started(self):
+        with self._lock:
+            self.jobs_in_flight += 1
+
+    def job_finished(self, seconds):
+        with self._lock:
+            self.jobs_in_flight -= 1
+            self.jobs_total += 1
+            self.job_seconds_sum += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.job_buckets[i] += 1
+                    break
+            else:
+                self.job_buckets[-1] += 1
+
+    @contextlib.contextmanager
+    def job(self):
+        start = time.monotonic()
+        self.job_started()
+        try:
+            yield
+        finally:
+            self.job_finished(time.monotonic() - start)
+
+    def heartbeat_age(self):
+        return time.monotonic() - (self.last_beat or self.started)
+
+    def problem(self):
+        """Why the worker is unhealthy, or None."""
+        for thread in self._threads:
+            if not thread.is_alive():
+                return f"worker thread {thread.name} died"
+        if not self._threads and self.last_beat is None:
+            return None  # no worker loop in this process
+        if self.heartbeat_age() > self.stale_after:
+            return f"worker loop stalled for {self.heartbeat_age():.0f}s"
+        return None
+
+    def render(self):
+        """Prometheus exposition lines for this process."""
+        labels = f'service="{self.service}"'
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        lines = []
+
+        def sample(name, mtype, value):
+            lines.append(f"# TYPE {name} {mtype}")
+            lines.append(f"{name}{{{labels}}} {value}")
+
+        sample("karaoke_process_cpu_seconds_total", "counter", usage.ru_utime + usage.ru_stime)
+        sample(
+            "karaoke_process_children_cpu_seconds_total",
+            "counter",
+            children.ru_utime + children.ru_stime,
+        )
+        sample("karaoke_process_resident_memory_bytes", "gauge", process_rss_bytes())
+        sample("karaoke_worker_up", "gauge", 0 if self.problem() else 1)
+        sample("karaoke_worker_heartbeat_age_seconds", "gauge", round(self.heartbeat_age(), 3))
+        sample("karaoke_worker_loop_lag_seconds", "gauge", round(self.loop_lag, 3))
+        sample("karaoke_worker_loop_iterations_total", "counter", self.iterations)
+        sample("karaoke_worker_jobs_in_flight", "gauge", self.jobs_in_flight)
+
+        name = "karaoke_worker_job_duration_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(list(LATENCY_BUCKETS) + ["+Inf"], self.job_buckets):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.job_seconds_sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.jobs_total}")
+        return lines
+
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss (peak, KiB on Linux) where /proc is unavailable.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# One monitor per service process.
+worker_monitor = WorkerMonitor()
+
+
+def start_worker(service, target):
+    """Run a service's worker loop in a daemon thread watched by worker_monitor."""
+    worker_monitor.service = service
+    thread = threading.Thread(target=target, daemon=True, name=f"{service}-worker")
+    worker_monitor.watch(thread)
+    thread.start()
+    return thread
+
+
 # -------- HEALTHCHECK UTILS --------
 
 
 def health_response():
-    """Simple Flask healthcheck endpoint."""
+    """Flask healthcheck response: 503 when the worker loop died or stalled."""
+    problem = worker_monitor.problem()
+    if problem:
+        return problem, 503
     return "ok", 200
+
+
+def metrics_response():
+    """Flask response with this process's Prometheus metrics."""
+    body = "\n".join(worker_monitor.render()) + "\n"
+    return body, 200, {"Content-Type": "text/plain; version=0.0.4"}
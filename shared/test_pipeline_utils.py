@@ -0,0 +1,103 @@
+import pytest
+
+from shared import pipeline_utils
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+SCRIPTS = ("_set_status_script", "_merge_metadata_script")
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    """Point pipeline_utils (and its Lua scripts) at an in-memory Redis."""
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(pipeline_utils, "redis_client", client)
+    for name in SCRIPTS:
+        monkeypatch.setattr(getattr(pipeline_utils, name), "registered_client", client)
+    return client
+
+
+def test_bot_metadata_after_extraction_wins(redis_client):
+    tags = {"TIT2": "track01", "TPE1": "Unknown Artist", "TALB": "Unknown Album", "TRCK": "1"}
+    pipeline_utils.set_file_metadata("song.mp3", tags)
+
+    chosen = {"TIT2": "Real Title", "TPE1": "Real Artist", "TALB": "Real Album"}
+    assert pipeline_utils.merge_file_metadata("song.mp3", chosen)
+
+    assert pipeline_utils.get_file_metadata("song.mp3") == {**chosen, "TRCK": "1"}
+    assert pipeline_utils.get_file_status("song.mp3")["status"] == "metadata_extracted"
+
+
+def test_bot_metadata_for_unknown_file_is_left_to_the_sidecar(redis_client):
+    assert not pipeline_utils.merge_file_metadata("new.mp3", {"TIT2": "Title"})
+    assert not redis_client.exists("file:new.mp3")
+
+
+def test_reset_from_error_restarts_the_preview_cycle(redis_client):
+    pipeline_utils.set_file_status(
+        "song.mp3", "split", extra={"source": "bot", pipeline_utils.PREVIEW_FIELD: "split"}
+    )
+    pipeline_utils.set_file_error("song.mp3", "boom")
+    pipeline_utils.clear_file_error("song.mp3")
+
+    record = pipeline_utils.get_file_records(["song.mp3"])[0]
+    assert record["status"] == "queued"
+    assert pipeline_utils.wants_preview(record)
+
+
+def test_full_split_hands_priority_back_to_the_source(redis_client):
+    pipeline_utils.set_file_status(
+        "song.mp3",
+        "metadata_extracted",
+        extra={
+            "source": "bot",
+            pipeline_utils.PREVIEW_FIELD: "packaged",
+            pipeline_utils.PRIORITY_FIELD: pipeline_utils.PREVIEW_FULL_PRIORITY,
+        },
+    )
+    assert pipeline_utils.get_scheduled_queue("metadata_extracted")[0]["priority"] == 2
+
+    pipeline_utils.set_file_status(
+        "song.mp3", "split", remove_fields=pipeline_utils.PREVIEW_CYCLE_FIELDS
+    )
+    pipeline_utils.set_file_status("song.mp3", "metadata_extracted")
+    assert pipeline_utils.get_scheduled_queue("metadata_extracted")[0]["priority"] == 0
+
+
+def test_failure_writes_need_the_current_lease(redis_client):
+    pipeline_utils.set_file_status("song.mp3", "metadata_extracted")
+    stale = "worker-a:stale"
+    assert pipeline_utils.claim_file("song.mp3", "metadata_extracted", "splitting", owner=stale)
+    # The lease expired and another replica claimed the file again.
+    pipeline_utils.set_file_status("song.mp3", "metadata_extracted")
+    current = "worker-b:current"
+    assert pipeline_utils.claim_file("song.mp3", "metadata_extracted", "splitting", owner=current)
+
+    assert not pipeline_utils.schedule_retry("splitter", "song.mp3", 10, "boom", owner=stale)
+    assert pipeline_utils.set_file_error("song.mp3", "boom", "splitter", owner=stale) is None
+    assert pipeline_utils.get_file_status("song.mp3")["status"] == "splitting"
+    assert not redis_client.exists("retry_schedule:splitter", "splitter_retries:song.mp3")
+
+    assert pipeline_utils.schedule_retry("splitter", "song.mp3", 10, "boom", owner=current)
+    assert pipeline_utils.get_file_status("song.mp3")["status"] == pipeline_utils.RETRY_STATUS
+    assert redis_client.zscore("retry_schedule:splitter", "song.mp3") is not None
+
+
+def test_rebuild_keeps_transitions_made_during_the_scan(redis_client, monkeypatch):
+    for name in ("a.mp3", "b.mp3"):
+        pipeline_utils.set_file_status(name, "queued")
+    redis_client.delete("status_index:queued")
+    scan_iter = redis_client.scan_iter
+
+    def racing_scan_iter(match=None, **kwargs):
+        yield from scan_iter(match=match, **kwargs)
+        if match == "file:*":
+            pipeline_utils.set_file_status("a.mp3", "split")
+
+    monkeypatch.setattr(redis_client, "scan_iter", racing_scan_iter)
+    counts = pipeline_utils.rebuild_status_index(batch_size=1)
+
+    assert counts == {"queued": 1, "split": 1}
+    assert pipeline_utils.get_files_by_status("queued") == ["b.mp3"]
+    assert pipeline_utils.get_files_by_status("split") == ["a.mp3"]
@@ -0,0 +1,152 @@
+"""
+Raw PCM audio I/O for the splitter.
+
+Audio moves through the splitter as float32 (samples, 2) arrays at SAMPLE_RATE:
+decoded by ffmpeg straight to raw PCM on a pipe (whole file, or block by block
+in streaming mode), and written as 16-bit WAV only where a file is needed.
+"""
+
+import os
+import wave
+import subprocess
+import tempfile
+import numpy as np
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+# Scratch space for the CLI engine's chunk/stem files; tmpfs when available.
+SPLITTER_TMP_DIR = os.environ.get(
+    "SPLITTER_TMP_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
+
+
+def _ffmpeg_decode_cmd(path):
+    return [
+        "ffmpeg",
+        "-v",
+        "error",
+        "-i",
+        path,
+        "-f",
+        "f32le",
+        "-ac",
+        str(CHANNELS),
+        "-ar",
+        str(SAMPLE_RATE),
+        "-",
+    ]
+
+
+def decode_audio(path):
+    """Decode any ffmpeg-readable file to a float32 (samples, 2) array."""
+    result = subprocess.run(
+        _ffmpeg_decode_cmd(path), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg decode error: {result.stderr.decode(errors='replace')}")
+    return np.frombuffer(result.stdout, dtype="<f4").reshape(-1, CHANNELS)
+
+
+def probe_duration(path):
+    """Return the duration in seconds reported by ffprobe, or None."""
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=duration",
+            "-of",
+            "default=noprint_wrappers=1:nokey=1",
+            path,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+
+def iter_pcm_blocks(path, block_samples):
+    """Yield float32 (<=block_samples, 2) arrays decoded incrementally by ffmpeg."""
+    block_bytes = block_samples * CHANNELS * 4
+    proc = subprocess.Popen(
+        _ffmpeg_decode_cmd(path), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    try:
+        while True:
+            data = proc.stdout.read(block_bytes)
+            if not data:
+                break
+            usable = len(data) - len(data) % (CHANNELS * 4)
+            yield np.frombuffer(data[:usable], dtype="<f4").reshape(-1, CHANNELS)
+        stderr = proc.stderr.read()
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg decode error: {stderr.decode(errors='replace')}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+
+def to_pcm16(waveform):
+    return (np.clip(waveform, -1.0, 1.0) * 32767).astype("<i2")
+
+
+def write_wav(path, waveform, sample_rate=SAMPLE_RATE):
+    """
+    Write a float32 (samples, channels) array as a 16-bit PCM WAV in one pass.
+
+    Written under a temp name and renamed into place, never rewritten in
+    place: `path` may be a hardlink shared with a stem cache entry.
+    """
+    pcm = to_pcm16(waveform)
+    part = f"{path}.part"
+    with wave.open(part, "wb") as wav:
+        wav.setnchannels(pcm.shape[1])
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm.tobytes())
+    os.replace(part, path)
+
+
+def read_wav(path):
+    """Read a 16-bit PCM WAV into a float32 (samples, channels) array."""
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"Unsupported WAV sample width in {path}")
+        channels = wav.getnchannels()
+        frames = wav.readframes(wav.getnframes())
+    samples = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768.0
+    samples = samples.reshape(-1, channels)
+    if channels == 1:
+        samples = np.repeat(samples, CHANNELS, axis=1)
+    return samples
+
+
+class WavStreamWriter:
+    """Append float32 blocks to a 16-bit WAV; renamed into place on close()."""
+
+    def __init__(self, path, channels=CHANNELS, sample_rate=SAMPLE_RATE):
+        self.path = path
+        self._part = f"{path}.part"
+        self._wav = wave.open(self._part, "wb")
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(sample_rate)
+
+    def write(self, waveform):
+        if len(waveform):
+            self._wav.writeframes(to_pcm16(waveform).tobytes())
+
+    def close(self):
+        self._wav.close()
+        os.replace(self._part, self.path)
+
+    def abort(self):
+        self._wav.close()
+        if os.path.exists(self._part):
+            os.remove(self._part)
@@ -0,0 +1,103 @@
+"""
+Per-chunk checkpoints for the splitter.
+
+Every separated chunk is saved to SPLITTER_WORK_DIR/<key>/ as soon as it comes
+out of the separator, where the key hashes the song's content key together
+with the chunk layout (anything that changes what a chunk contains). A retry,
+or a restart after a crash, loads the chunks already done and separates only
+from the first missing one; the directory is removed once the final stems are
+written. Directories nobody came back for are pruned after
+SPLITTER_CHECKPOINT_MAX_AGE seconds.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STEMS_DIR = os.environ.get("STEMS_DIR", "/stems")
+# Must survive restarts, so it defaults to the stems volume (hidden dirs there
+# are ignored by the rest of the pipeline).
+SPLITTER_WORK_DIR = os.environ.get("SPLITTER_WORK_DIR", os.path.join(STEMS_DIR, ".work"))
+SPLITTER_CHECKPOINT_MAX_AGE = int(os.environ.get("SPLITTER_CHECKPOINT_MAX_AGE", 7 * 24 * 3600))
+STEM_NAMES = ("vocals", "accompaniment")
+
+
+class ChunkCheckpoints:
+    def __init__(self, key, *params, root=SPLITTER_WORK_DIR):
+        digest = hashlib.sha256(key.encode())
+        for param in params:
+            digest.update(f"\0{param}".encode())
+        self.path = os.path.join(root, digest.hexdigest())
+
+    def _chunk_path(self, idx, stem):
+        return os.path.join(self.path, f"{idx:05d}.{stem}.npy")
+
+    def has(self, idx):
+        return all(os.path.exists(self._chunk_path(idx, stem)) for stem in STEM_NAMES)
+
+    def completed(self):
+        """Number of leading chunks already checkpointed (chunks finish in order)."""
+        count = 0
+        while self.has(count):
+            count += 1
+        return count
+
+    def load(self, idx):
+        return tuple(np.load(self._chunk_path(idx, stem)) for stem in STEM_NAMES)
+
+    def save(self, idx, vocals, accompaniment):
+        os.makedirs(self.path, exist_ok=True)
+        for stem, waveform in zip(STEM_NAMES, (vocals, accompaniment)):
+            path = self._chunk_path(idx, stem)
+            part = f"{path}.part"
+            with open(part, "wb") as f:
+                np.save(f, np.asarray(waveform, dtype=np.float32))
+            os.replace(part, path)
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def separate_resumable(separator, chunks, checkpoints, on_resumed=None):
+    """
+    Wrap separator.separate_many(chunks) with checkpoints.
+
+    Yields (vocals, accompaniment, seconds) per chunk in order; seconds is
+    None for chunks loaded from a checkpoint. Their waveforms are still pulled
+    from `chunks` (keeping a streaming decode in step) but never separated;
+    they are passed to `on_resumed`, if given, so per-file statistics still
+    cover the whole song.
+    """
+    chunks = iter(chunks)
+    done = checkpoints.completed()
+    if done:
+        logger.info(f"Resuming after {done} checkpointed chunks")
+    for idx in range(done):
+        waveform = next(chunks, None)
+        if waveform is None:
+            return
+        if on_resumed:
+            on_resumed(waveform)
+        yield (*checkpoints.load(idx), None)
+    for idx, (vocals, accompaniment, elapsed) in enumerate(
+        separator.separate_many(chunks), done
+    ):
+        checkpoints.save(idx, vocals, accompaniment)
+        yield vocals, accompaniment, elapsed
+
+
+def prune_checkpoints(root=SPLITTER_WORK_DIR, max_age=SPLITTER_CHECKPOINT_MAX_AGE):
+    """Remove checkpoint directories untouched for `max_age` seconds."""
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - max_age
+    with os.scandir(root) as it:
+        for item in it:
+            if item.is_dir() and item.stat().st_mtime < cutoff:
+                shutil.rmtree(item.path, ignore_errors=True)
+                logger.info(f"Pruned stale chunk checkpoints {item.name}")
@@ -0,0 +1,41 @@
+"""
+Instant preview accompaniment for the splitter (pure NumPy, no model).
+
+Lead vocals are usually mixed to the centre, so subtracting the channels
+(mid/side centre-channel cancellation) removes most of them in one vectorized
+pass. Bass and kick drum sit in the centre too; the mid signal's low end
+(below PREVIEW_BASS_HZ, via a moving average) is added back so the preview
+keeps its groove. Quality is well below a real separation, but it is ready in
+seconds instead of minutes.
+"""
+
+import os
+import numpy as np
+from audio_io import SAMPLE_RATE, decode_audio, write_wav
+
+PREVIEW_BASS_HZ = float(os.environ.get("PREVIEW_BASS_HZ", 120))
+
+
+def moving_average(signal, width):
+    """Centred moving average of a 1-D signal (edges padded), same length."""
+    if width <= 1:
+        return signal
+    half = width // 2
+    padded = np.pad(signal, (half, width - half), mode="edge")
+    sums = np.concatenate(([0.0], np.cumsum(padded, dtype=np.float64)))
+    return ((sums[width:] - sums[:-width])[: len(signal)] / width).astype(np.float32)
+
+
+def center_cancel(waveform, bass_hz=PREVIEW_BASS_HZ, sample_rate=SAMPLE_RATE):
+    """Stereo (samples, 2) accompaniment: side signal plus the mid's low end."""
+    left, right = waveform[:, 0], waveform[:, 1]
+    side = (left - right) * 0.5
+    bass = 0.0
+    if bass_hz > 0:
+        bass = moving_average((left + right) * 0.5, int(sample_rate / bass_hz))
+    return np.stack([bass + side, bass - side], axis=1).astype(np.float32)
+
+
+def write_preview(file_path, out_path):
+    """Decode `file_path` and write its preview accompaniment as a WAV."""
+    write_wav(out_path, center_cancel(decode_audio(file_path)))
@@ -0,0 +1,286 @@
+"""
+Separation engines for the splitter service.
+
+- InProcessSeparator: loads the spleeter model once per process (with a warmup
+  pass) and separates waveforms in memory.
+- CliSeparator: the original `spleeter separate` subprocess per chunk, kept as a
+  fallback mode.
+- SeparatorPool: runs either engine in SPLITTER_WORKERS worker processes so the
+  chunks of one song are separated concurrently.
+
+Engines take a float32 (samples, 2) waveform at SAMPLE_RATE and return
+(vocals, accompaniment) arrays of the same shape. `separate_many` yields
+(vocals, accompaniment, seconds) per chunk, in chunk order.
+"""
+
+import os
+import time
+import logging
+import tempfile
+import subprocess
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from audio_io import SAMPLE_RATE, SPLITTER_TMP_DIR, read_wav, write_wav
+
+logger = logging.getLogger(__name__)
+
+SPLITTER_ENGINE = os.environ.get("SPLITTER_ENGINE", "inprocess").lower()
+SPLEETER_MODEL = os.environ.get("SPLEETER_MODEL", "spleeter:2stems")
+SPLITTER_WORKERS = int(os.environ.get("SPLITTER_WORKERS", 1))
+# Threads each worker's ML runtime may use (0 = runtime default).
+SPLITTER_THREADS_PER_WORKER = int(os.environ.get("SPLITTER_THREADS_PER_WORKER", 0))
+# Chunks submitted but not yet stitched; bounds memory held by the pool.
+SPLITTER_MAX_INFLIGHT = int(
+    os.environ.get("SPLITTER_MAX_INFLIGHT", 2 * max(SPLITTER_WORKERS, 1))
+)
+
+
+def limit_runtime_threads(threads):
+    """Cap BLAS/OpenMP/TensorFlow thread pools; must run before TF is imported."""
+    if not threads:
+        return
+    for var in (
+        "OMP_NUM_THREADS",
+        "MKL_NUM_THREADS",
+        "OPENBLAS_NUM_THREADS",
+        "TF_NUM_INTRAOP_THREADS",
+        "TF_NUM_INTEROP_THREADS",
+    ):
+        os.environ[var] = str(threads)
+
+
+class BaseSeparator:
+    name = None
+
+    def __init__(self, model=SPLEETER_MODEL, threads=SPLITTER_THREADS_PER_WORKER):
+        self.model = model
+        self.threads = threads
+        self.startup_seconds = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def separate(self, waveform):
+        raise NotImplementedError
+
+    def separate_many(self, waveforms):
+        for idx, waveform in enumerate(waveforms):
+            start = time.monotonic()
+            try:
+                vocals, accompaniment = self.separate(waveform)
+            except Exception as e:
+                raise RuntimeError(f"Separation error (chunk {idx}): {e}") from e
+            yield vocals, accompaniment, time.monotonic() - start
+
+
+class InProcessSeparator(BaseSeparator):
+    """Keeps a spleeter Separator resident for the lifetime of the process."""
+
+    name = "inprocess"
+
+    def __init__(self, model=SPLEETER_MODEL, threads=SPLITTER_THREADS_PER_WORKER):
+        super().__init__(model, threads)
+        self._separator = None
+
+    def load(self):
+        """Import TensorFlow, build the model and run one warmup separation."""
+        start = time.monotonic()
+        limit_runtime_threads(self.threads)
+        import tensorflow as tf
+        from spleeter.separator import Separator
+
+        if self.threads:
+            tf.config.threading.set_intra_op_parallelism_threads(self.threads)
+            tf.config.threading.set_inter_op_parallelism_threads(self.threads)
+
+        self._separator = Separator(self.model, multiprocess=False)
+        # The first call builds the graph and restores the checkpoint; pay that
+        # at startup instead of on the first real chunk.
+        self._separator.separate(np.zeros((SAMPLE_RATE, 2), dtype=np.float32))
+        self.startup_seconds = time.monotonic() - start
+        logger.info(
+            f"Loaded {self.model} in-process in {self.startup_seconds:.1f}s"
+        )
+        return self
+
+    def separate(self, waveform):
+        prediction = self._separator.separate(waveform)
+        return prediction["vocals"], prediction["accompaniment"]
+
+
+class CliSeparator(BaseSeparator):
+    """Runs the spleeter CLI once per chunk (cold model load every call)."""
+
+    name = "cli"
+
+    def load(self):
+        limit_runtime_threads(self.threads)
+        self.startup_seconds = 0.0
+        return self
+
+    def separate(self, waveform):
+        # Lossless WAV in tmpfs: no MP3 generation loss and no disk I/O.
+        with tempfile.TemporaryDirectory(dir=SPLITTER_TMP_DIR) as temp_dir:
+            chunk_path = os.path.join(temp_dir, "chunk.wav")
+            write_wav(chunk_path, waveform)
+            output_dir = os.path.join(temp_dir, "output")
+            os.makedirs(output_dir, exist_ok=True)
+            result = subprocess.run(
+                [
+                    "spleeter",
+                    "separate",
+                    "-p",
+                    self.model,
+                    "-o",
+                    output_dir,
+                    chunk_path,
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            if result.returncode != 0:
+                raise RuntimeError(f"Spleeter error: {result.stderr}")
+            stem_dir = os.path.join(output_dir, "chunk")
+            vocals_path = os.path.join(stem_dir, "vocals.wav")
+            acc_path = os.path.join(stem_dir, "accompaniment.wav")
+            if not (os.path.exists(vocals_path) and os.path.exists(acc_path)):
+                raise FileNotFoundError(
+                    f"Missing stems: {vocals_path}, {acc_path}"
+                )
+            return read_wav(vocals_path), read_wav(acc_path)
+
+
+ENGINES = {
+    InProcessSeparator.name: InProcessSeparator,
+    CliSeparator.name: CliSeparator,
+}
+
+# Engine owned by a SeparatorPool worker process.
+_worker_separator = None
+
+
+def _init_worker(engine, model, threads):
+    global _worker_separator
+    _worker_separator = _load_engine(engine, model, threads)
+
+
+def _worker_startup_seconds():
+    return _worker_separator.startup_seconds
+
+
+def _worker_separate(waveform):
+    start = time.monotonic()
+    vocals, accompaniment = _worker_separator.separate(waveform)
+    return vocals, accompaniment, time.monotonic() - start
+
+
+class SeparatorPool:
+    """
+    Separates chunks concurrently in worker processes, each holding its own
+    engine, and yields results in chunk order with at most `max_inflight`
+    chunks outstanding.
+    """
+
+    def __init__(
+        self,
+        engine=SPLITTER_ENGINE,
+        model=SPLEETER_MODEL,
+        workers=SPLITTER_WORKERS,
+        threads=SPLITTER_THREADS_PER_WORKER,
+        max_inflight=SPLITTER_MAX_INFLIGHT,
+    ):
+        self.engine = engine
+        self.model = model
+        self.workers = workers
+        self.threads = threads
+        self.max_inflight = max(max_inflight, workers)
+        self.name = f"{engine}_pool"
+        self.startup_seconds = None
+        self._executor = None
+
+    def _start(self):
+        # TensorFlow is not fork-safe, so workers are spawned fresh.
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.engine, self.model, self.threads),
+        )
+
+    def load(self):
+        """Start the workers and wait until their engines are loaded."""
+        start = time.monotonic()
+        self._start()
+        futures = [
+            self._executor.submit(_worker_startup_seconds) for _ in range(self.workers)
+        ]
+        for future in futures:
+            future.result()
+        self.startup_seconds = time.monotonic() - start
+        logger.info(
+            f"Started {self.workers} {self.engine} separator workers "
+            f"in {self.startup_seconds:.1f}s"
+        )
+        return self
+
+    def separate(self, waveform):
+        return self._executor.submit(_worker_separate, waveform).result()[:2]
+
+    def separate_many(self, waveforms):
+        chunks = enumerate(waveforms)
+        pending = collections.deque()
+
+        def submit_next():
+            for idx, waveform in chunks:
+                pending.append((idx, self._executor.submit(_worker_separate, waveform)))
+                return True
+            return False
+
+        while len(pending) < self.max_inflight and submit_next():
+            pass
+        try:
+            while pending:
+                idx, future = pending.popleft()
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    logger.error("Separator worker died; restarting pool")
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                    self._start()
+                    raise RuntimeError(f"Separation worker died (chunk {idx})")
+                except Exception as e:
+                    raise RuntimeError(f"Separation error (chunk {idx}): {e}") from e
+                submit_next()
+                yield result
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _load_engine(engine, model=SPLEETER_MODEL, threads=SPLITTER_THREADS_PER_WORKER):
+    if engine not in ENGINES:
+        logger.warning(f"Unknown SPLITTER_ENGINE '{engine}', using 'inprocess'")
+        engine = InProcessSeparator.name
+    try:
+        return ENGINES[engine](model, threads).load()
+    except Exception as e:
+        if engine == CliSeparator.name:
+            raise
+        logger.error(f"In-process separator failed to load ({e}); falling back to CLI")
+        return CliSeparator(model, threads).load()
+
+
+def create_separator(engine=SPLITTER_ENGINE, workers=SPLITTER_WORKERS):
+    """
+    Build and load the configured engine, pooled when `workers` > 1.
+
+    If the in-process engine cannot be loaded (e.g. TensorFlow fails to import),
+    fall back to the CLI engine so the service keeps working.
+    """
+    if workers > 1:
+        return SeparatorPool(engine=engine, workers=workers).load()
+    return _load_engine(engine)
@@ -0,0 +1,177 @@
+"""
+Silence skipping for the splitter.
+
+SilenceSkipper wraps a separation engine. Before a chunk reaches the model,
+its RMS energy is measured over short frames (one vectorized pass). A chunk
+that is silent throughout bypasses the model: zero vocals, the original audio
+as accompaniment. Silent stretches of at least SILENCE_MIN_MS at either end of
+a chunk are cut off the model input the same way, keeping SILENCE_PAD_MS of
+context next to the audible part. Chunks keep their order and length, so the
+stitching downstream is unchanged.
+"""
+
+import os
+import collections
+import numpy as np
+from audio_io import SAMPLE_RATE
+
+SILENCE_SKIP = os.environ.get("SILENCE_SKIP", "true").lower() in ("1", "true", "yes")
+# Frames quieter than this (dBFS RMS) count as silent.
+SILENCE_THRESHOLD_DB = float(os.environ.get("SILENCE_THRESHOLD_DB", -50))
+SILENCE_FRAME_MS = int(os.environ.get("SILENCE_FRAME_MS", 50))
+SILENCE_MIN_MS = int(os.environ.get("SILENCE_MIN_MS", 2000))
+SILENCE_PAD_MS = int(os.environ.get("SILENCE_PAD_MS", 500))
+
+
+def ms_to_samples(ms):
+    return int(SAMPLE_RATE * ms / 1000)
+
+
+def frame_rms(waveform, frame_samples):
+    """RMS of each `frame_samples` frame of the channel mix (last frame may be short)."""
+    mono = waveform.mean(axis=1, dtype=np.float32)
+    full = len(mono) // frame_samples * frame_samples
+    rms = np.sqrt(np.mean(np.square(mono[:full]).reshape(-1, frame_samples), axis=1))
+    if full < len(mono):
+        rms = np.append(rms, np.sqrt(np.mean(np.square(mono[full:]))))
+    return rms
+
+
+class SilenceSkipper:
+    def __init__(
+        self,
+        separator,
+        enabled=SILENCE_SKIP,
+        threshold_db=SILENCE_THRESHOLD_DB,
+        frame_ms=SILENCE_FRAME_MS,
+        min_ms=SILENCE_MIN_MS,
+        pad_ms=SILENCE_PAD_MS,
+    ):
+        self.separator = separator
+        self.enabled = enabled
+        self.threshold = 10 ** (threshold_db / 20)
+        self.frame_samples = max(ms_to_samples(frame_ms), 1)
+        self.min_samples = ms_to_samples(min_ms)
+        self.pad_samples = ms_to_samples(pad_ms)
+        self.skipped_samples = 0
+        self.total_samples = 0
+
+    @property
+    def name(self):
+        return self.separator.name
+
+    @property
+    def startup_seconds(self):
+        return self.separator.startup_seconds
+
+    @property
+    def skipped_fraction(self):
+        """Share of the audio since reset_stats() the model never saw (or would not have)."""
+        return self.skipped_samples / self.total_samples if self.total_samples else 0.0
+
+    def reset_stats(self):
+        """Start counting skipped audio for a new file."""
+        self.skipped_samples = 0
+        self.total_samples = 0
+
+    def _count(self, waveform, span):
+        self.total_samples += len(waveform)
+        if span is None:
+            self.skipped_samples += len(waveform)
+        else:
+            self.skipped_samples += len(waveform) - (span[1] - span[0])
+
+    def _plan(self, waveform):
+        """active_span() of a chunk, counted in the per-file statistics."""
+        span = self.active_span(waveform)
+        self._count(waveform, span)
+        return span
+
+    def account(self, waveform):
+        """
+        Count a chunk that is not separated now (e.g. resumed from a
+        checkpoint) as if it had gone through separate_many().
+        """
+        self._plan(waveform)
+
+    def active_span(self, waveform):
+        """(start, end) of the part of a chunk the model must see, or None if silent."""
+        length = len(waveform)
+        if not self.enabled or not length:
+            return (0, length)
+        active = np.flatnonzero(frame_rms(waveform, self.frame_samples) > self.threshold)
+        if not len(active):
+            return None
+        start = max(active[0] * self.frame_samples - self.pad_samples, 0)
+        end = min((active[-1] + 1) * self.frame_samples + self.pad_samples, length)
+        # Only worth cutting off long silent stretches.
+        if start < self.min_samples:
+            start = 0
+        if length - end < self.min_samples:
+            end = length
+        return (start, end)
+
+    def _merge(self, waveform, span, vocals=None, accompaniment=None):
+        """Full-length stems: model output inside `span`, pass-through outside."""
+        full_vocals = np.zeros_like(waveform)
+        full_accompaniment = np.array(waveform, dtype=np.float32)
+        if span is not None:
+            start, end = span
+            n = min(end - start, len(vocals), len(accompaniment))
+            full_vocals[start:start + n] = vocals[:n]
+            full_accompaniment[start:start + n] = accompaniment[:n]
+        return full_vocals, full_accompaniment
+
+    def separate(self, waveform):
+        vocals, accompaniment, _ = next(self.separate_many([waveform]))
+        return vocals, accompaniment
+
+    def separate_many(self, waveforms):
+        """
+        Same contract as the wrapped engine's separate_many(); only the audible
+        parts are submitted to it, and bypassed chunks report 0 seconds.
+        Skipped audio adds to the counts since reset_stats(), alongside chunks
+        passed to account().
+
+        Each run of consecutive audible chunks is one engine call (so a pool
+        keeps pipelining within it); a silent chunk ends the run and is
+        emitted as soon as the run's results are out. Only chunks in flight
+        in the engine are held, however long the silence, which keeps the
+        streaming mode's memory bound.
+        """
+        waveforms = iter(waveforms)
+        # Audible chunks handed to the engine whose results are not out yet.
+        in_flight = collections.deque()
+        # The silent chunk (and its span) that ended the current run.
+        held = []
+
+        def next_plan():
+            waveform = next(waveforms, None)
+            return None if waveform is None else (waveform, self._plan(waveform))
+
+        def audible_run(plan):
+            while plan is not None:
+                if plan[1] is None:
+                    held.append(plan)
+                    return
+                in_flight.append(plan)
+                waveform, (start, end) = plan
+                yield waveform[start:end]
+                plan = next_plan()
+
+        plan = next_plan()
+        while plan is not None:
+            waveform, span = plan
+            if span is None:
+                yield (*self._merge(waveform, None), 0.0)
+                plan = next_plan()
+                continue
+            for vocals, accompaniment, elapsed in self.separator.separate_many(
+                audible_run(plan)
+            ):
+                waveform, span = in_flight.popleft()
+                if span == (0, len(waveform)):
+                    yield vocals, accompaniment, elapsed
+                else:
+                    yield (*self._merge(waveform, span, vocals, accompaniment), elapsed)
+            plan = held.pop() if held else None
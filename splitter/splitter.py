@@ -1,21 +1,46 @@
 import os
 import time
 import logging
-import tempfile
-import subprocess
-from pydub import AudioSegment
-from pydub.utils import make_chunks
+from flask import Flask
 from shared.pipeline_utils import (
     set_file_status,
-    get_files_by_status,
+    iter_scheduled_files,
+    get_file_records,
+    wants_preview,
+    lease_keeper,
+    PREVIEW_FIELD,
+    PREVIEW_CYCLE_FIELDS,
+    PREVIEW_STEM_FILE,
     set_file_error,
     notify_all,
     clean_string,
-    redis_client,
     handle_auto_retry,
+    incr_metric,
+    set_metric,
+    worker_monitor,
+    start_worker,
+    health_response,
+    metrics_response,
+)
+from separator import create_separator, SPLEETER_MODEL
+from stem_cache import StemCache
+from checkpoints import ChunkCheckpoints, separate_resumable, prune_checkpoints
+from silence import SilenceSkipper
+from preview import write_preview
+from stitching import (
+    plan_chunks,
+    OverlapAddStitcher,
+    iter_overlapping_chunks,
+    StreamingOverlapAddWriter,
+)
+from audio_io import (
+    SAMPLE_RATE,
+    decode_audio,
+    iter_pcm_blocks,
+    probe_duration,
+    write_wav,
+    WavStreamWriter,
 )
-import traceback
-import datetime
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 LEVELS = {
@@ -40,106 +65,212 @@ STEMS_DIR = os.environ.get("STEMS_DIR", "/stems")
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 3))
 RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 10))
 CHUNK_LENGTH_MS = int(os.environ.get("CHUNK_LENGTH_MS", 30000))
+# Chunks overlap by this much and are crossfaded when stitched back together.
+CHUNK_OVERLAP_MS = int(os.environ.get("CHUNK_OVERLAP_MS", 1000))
+# "auto" streams songs longer than STREAMING_MIN_SECONDS; "on"/"off" force it.
+SPLITTER_STREAMING = os.environ.get("SPLITTER_STREAMING", "auto").lower()
+STREAMING_MIN_SECONDS = int(os.environ.get("STREAMING_MIN_SECONDS", 600))
 
 
-def process_file(file_path, song_name):
-    """Split an MP3 into stems in chunks, merge results, write output."""
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            audio = AudioSegment.from_file(file_path)
-            chunks = make_chunks(audio, CHUNK_LENGTH_MS)
-            vocals = AudioSegment.empty()
-            accompaniment = AudioSegment.empty()
-            with tempfile.TemporaryDirectory() as temp_dir:
-                for idx, chunk in enumerate(chunks):
-                    chunk_path = os.path.join(temp_dir, f"chunk_{idx}.mp3")
-                    chunk.export(chunk_path, format="mp3")
-                    output_dir = os.path.join(temp_dir, f"output_{idx}")
-                    os.makedirs(output_dir, exist_ok=True)
-                    result = subprocess.run(
-                        [
-                            "spleeter",
-                            "separate",
-                            "-p",
-                            "spleeter:2stems",
-                            "-o",
-                            output_dir,
-                            chunk_path,
-                        ],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                    )
-                    if result.returncode != 0:
-                        raise RuntimeError(
-                            f"Spleeter error (chunk {idx}): {result.stderr}"
-                        )
-                    stem_dir = os.path.join(output_dir, f"chunk_{idx}")
-                    vocals_path = os.path.join(stem_dir, "vocals.wav")
-                    acc_path = os.path.join(stem_dir, "accompaniment.wav")
-                    if not (os.path.exists(vocals_path) and os.path.exists(acc_path)):
-                        raise FileNotFoundError(
-                            f"Missing stems for chunk {idx}: {vocals_path}, {acc_path}"
-                        )
-                    vocals_chunk = AudioSegment.from_wav(vocals_path)
-                    accompaniment_chunk = AudioSegment.from_wav(acc_path)
-                    vocals += vocals_chunk
-                    accompaniment += accompaniment_chunk
-                out_dir = os.path.join(STEMS_DIR, song_name)
-                os.makedirs(out_dir, exist_ok=True)
-                vocals.export(os.path.join(out_dir, "vocals.wav"), format="wav")
-                accompaniment.export(
-                    os.path.join(out_dir, "accompaniment.wav"), format="wav"
-                )
-            return True
-        except Exception as e:
-            if attempt < MAX_RETRIES:
-                time.sleep(RETRY_DELAY)
-            else:
-                return str(e)
+def ms_to_samples(ms):
+    return int(SAMPLE_RATE * ms / 1000)
+
+
+def record_chunk_metrics(elapsed):
+    # Long songs take minutes; each separated chunk counts as loop progress.
+    worker_monitor.beat()
+    if elapsed is None:
+        incr_metric("splitter", "chunks_resumed_total")
+        return
+    incr_metric("splitter", "chunks_separated_total")
+    incr_metric("splitter", "chunk_separation_seconds_sum", elapsed)
+    set_metric("splitter", "last_chunk_separation_seconds", round(elapsed, 3))
+
+
+def chunk_layout():
+    chunk_samples = ms_to_samples(CHUNK_LENGTH_MS)
+    overlap_samples = min(ms_to_samples(CHUNK_OVERLAP_MS), chunk_samples // 2)
+    return chunk_samples, overlap_samples
+
+
+def use_streaming(file_path):
+    """Decide per file whether to stream (see SPLITTER_STREAMING)."""
+    if SPLITTER_STREAMING in ("on", "true", "1"):
+        return True
+    if SPLITTER_STREAMING in ("off", "false", "0"):
+        return False
+    duration = probe_duration(file_path)
+    return duration is None or duration > STREAMING_MIN_SECONDS
+
+
+def separate_in_memory(file_path, out_dir, separator, checkpoints):
+    """Decode the whole song, stitch into preallocated arrays, write once."""
+    chunk_samples, overlap_samples = chunk_layout()
+    waveform = decode_audio(file_path)
+    spans = plan_chunks(len(waveform), chunk_samples, overlap_samples)
+    stitcher = OverlapAddStitcher(len(waveform), overlap_samples)
+    chunks = (waveform[start:end] for start, end in spans)
+    results = separate_resumable(
+        separator, chunks, checkpoints, on_resumed=separator.account
+    )
+    for (start, _), (vocals_chunk, accompaniment_chunk, elapsed) in zip(
+        spans, results
+    ):
+        record_chunk_metrics(elapsed)
+        stitcher.add(start, vocals_chunk, accompaniment_chunk)
+    write_wav(os.path.join(out_dir, "vocals.wav"), stitcher.vocals)
+    write_wav(os.path.join(out_dir, "accompaniment.wav"), stitcher.accompaniment)
+
+
+def separate_streaming(file_path, out_dir, separator, checkpoints):
+    """Decode, separate and write chunk by chunk; memory is bounded by a few chunks."""
+    chunk_samples, overlap_samples = chunk_layout()
+    blocks = iter_pcm_blocks(file_path, chunk_samples - overlap_samples)
+    chunks = iter_overlapping_chunks(blocks, chunk_samples, overlap_samples)
+    writer = StreamingOverlapAddWriter(
+        WavStreamWriter(os.path.join(out_dir, "vocals.wav")),
+        WavStreamWriter(os.path.join(out_dir, "accompaniment.wav")),
+        overlap_samples,
+    )
+    try:
+        for vocals_chunk, accompaniment_chunk, elapsed in separate_resumable(
+            separator, chunks, checkpoints, on_resumed=separator.account
+        ):
+            record_chunk_metrics(elapsed)
+            writer.add(vocals_chunk, accompaniment_chunk)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def process_file(file_path, song_name, separator, content_key, streaming):
+    """Split an MP3 into stems in chunks, merge results, write output.
+
+    Single attempt: failures propagate to handle_auto_retry, which schedules
+    a delayed retry instead of re-running spleeter in a loop here. Separated
+    chunks are checkpointed under `content_key` (the stem cache key) and the
+    chunk layout, so that retry resumes at the first missing chunk.
+    `streaming` is the caller's use_streaming() decision for the file.
+    Returns the fraction of the audio skipped as silence.
+    """
+    out_dir = os.path.join(STEMS_DIR, song_name)
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoints = ChunkCheckpoints(content_key, *chunk_layout(), SAMPLE_RATE)
+    separator.reset_stats()
+    if streaming:
+        logger.info(f"Separating {song_name} in streaming mode")
+        separate_streaming(file_path, out_dir, separator, checkpoints)
+    else:
+        separate_in_memory(file_path, out_dir, separator, checkpoints)
+    checkpoints.discard()
+    skipped = separator.skipped_fraction
+    incr_metric(
+        "splitter", "silence_skipped_seconds_total", separator.skipped_samples / SAMPLE_RATE
+    )
+    set_metric("splitter", "last_silence_skipped_ratio", round(skipped, 4))
+    logger.info(f"Separated {song_name}; {skipped:.1%} skipped as silence")
+    return skipped
+
+
+def make_preview(file, file_path, out_dir, owner):
+    """Write the instant DSP preview stem and hand the file on to the packager."""
+    start = time.monotonic()
+    os.makedirs(out_dir, exist_ok=True)
+    write_preview(file_path, os.path.join(out_dir, PREVIEW_STEM_FILE))
+    elapsed = time.monotonic() - start
+    incr_metric("splitter", "previews_total")
+    set_metric("splitter", "last_preview_seconds", round(elapsed, 3))
+    logger.info(f"Preview of {file} ready in {elapsed:.1f}s; full separation follows")
+    set_file_status(
+        file,
+        "split",
+        extra={PREVIEW_FIELD: "split"},
+        reset_retries="splitter",
+        owner=owner,
+    )
 
 
 def main():
-    while True:
-        files = get_files_by_status("metadata_extracted")
-        for file in files:
-            file_path = os.path.join(QUEUE_DIR, clean_string(file))
-            song_name = os.path.splitext(file)[0]
-            if not os.path.exists(file_path):
-                set_file_error(file, "File not found for splitting")
-                continue
-
-            def process_func():
-                result = process_file(file_path, clean_string(song_name))
-                if result is True:
-                    set_file_status(file, "split")
-                    redis_client.delete(f"splitter_retries:{file}")
-                    notify_all(
-                        "Karaoke Pipeline Success", f"✅ Split completed for {file}"
-                    )
-                else:
-                    raise Exception(result)
-                return True
-
-            try:
+    separator = SilenceSkipper(create_separator())
+    set_metric("splitter", "engine_startup_seconds", round(separator.startup_seconds, 3))
+    set_metric("splitter", f'engine_info{{engine="{separator.name}"}}', 1)
+    stem_cache = StemCache()
+    prune_checkpoints()
+    # Priority class, then shortest song first, with aging (see get_scheduled_queue).
+    for file in iter_scheduled_files("metadata_extracted", "splitter", "splitting"):
+        file_path = os.path.join(QUEUE_DIR, clean_string(file))
+        song_name = os.path.splitext(file)[0]
+        owner = lease_keeper.token(file)
+        if not os.path.exists(file_path):
+            set_file_error(file, "File not found for splitting", owner=owner)
+            continue
+
+        def process_func():
+            out_dir = os.path.join(STEMS_DIR, clean_string(song_name))
+            cache_key = stem_cache.key_for(file_path, SPLEETER_MODEL)
+            extra = {"content_hash": cache_key}
+            if stem_cache.materialize(cache_key, out_dir):
+                extra["stem_cache"] = "hit"
+                logger.info(f"Stem cache hit for {file} ({cache_key[:12]})")
+            else:
+                # Probed once per file: decides both the preview and the mode.
+                streaming = use_streaming(file_path)
+                if wants_preview(get_file_records([file])[0]) and not streaming:
+                    # Long files stream and are not previewed; a preview of
+                    # those would not be instant anyway.
+                    make_preview(file, file_path, out_dir, owner)
+                    return True
+                extra["stem_cache"] = "miss"
+                skipped = process_file(
+                    file_path, clean_string(song_name), separator, cache_key, streaming
+                )
+                extra["silence_skipped"] = round(skipped, 4)
+                cache_bytes = stem_cache.store(cache_key, out_dir)
+                set_metric("splitter", "stem_cache_bytes", cache_bytes)
+            incr_metric("splitter", f'stem_cache_requests_total{{result="{extra["stem_cache"]}"}}')
+            # Full-quality stems end the preview cycle: package them as usual.
+            if set_file_status(
+                file,
+                "split",
+                extra=extra,
+                reset_retries="splitter",
+                owner=owner,
+                remove_fields=PREVIEW_CYCLE_FIELDS,
+            ):
+                notify_all(
+                    "Karaoke Pipeline Success", f"✅ Split completed for {file}"
+                )
+            return True
+
+        try:
+            with worker_monitor.job():
                 handle_auto_retry(
                     "splitter",
                     file,
                     func=process_func,
                     max_retries=MAX_RETRIES,
                     retry_delay=RETRY_DELAY,
+                    owner=owner,
                 )
-            except Exception as e:
-                tb = traceback.format_exc()
-                timestamp = datetime.datetime.now().isoformat()
-                error_details = f"{timestamp}\nSplitter error: {e}\n\nTraceback:\n{tb}"
-                set_file_error(file, error_details)
-                notify_all(
-                    "Karaoke Pipeline Error", f"❌ Splitter failed for {file}: {e}"
-                )
-                redis_client.incr(f"splitter_retries:{file}")
-        time.sleep(5)
+        except Exception as e:
+            # handle_auto_retry already marked the file as failed and notified.
+            logger.error(f"Splitter gave up on {file}: {e}")
+
+
+app = Flask(__name__)
+
+
+@app.route("/health")
+def health():
+    return health_response()
+
+
+@app.route("/metrics")
+def metrics():
+    return metrics_response()
 
 
 if __name__ == "__main__":
-    main()
+    start_worker("splitter", main)
+    app.run(host="0.0.0.0", port=5000)
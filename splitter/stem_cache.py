@@ -0,0 +1,113 @@
+"""
+Content-addressed stem cache for the splitter.
+
+Entries live in STEM_CACHE_DIR/<key>/{vocals,accompaniment}.wav, where the key
+hashes the source file bytes together with the model, so the same audio dropped
+under another filename is never separated twice. Entries are hardlinked into
+STEMS_DIR/<song> on a hit (copied when hardlinks are not possible) and evicted
+least-recently-used first once the cache exceeds STEM_CACHE_MAX_BYTES.
+Because of the hardlinks, stems in STEMS_DIR must only ever be replaced by a
+rename (see audio_io.write_wav), never rewritten in place.
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+STEMS_DIR = os.environ.get("STEMS_DIR", "/stems")
+STEM_CACHE_DIR = os.environ.get("STEM_CACHE_DIR", os.path.join(STEMS_DIR, ".cache"))
+# 0 disables the cache.
+STEM_CACHE_MAX_BYTES = int(os.environ.get("STEM_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+STEM_FILES = ("vocals.wav", "accompaniment.wav")
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class StemCache:
+    def __init__(self, root=STEM_CACHE_DIR, max_bytes=STEM_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+        if self.enabled:
+            os.makedirs(root, exist_ok=True)
+
+    def key_for(self, file_path, *params):
+        """sha256 of the file bytes plus anything else that changes the stems."""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        for param in params:
+            digest.update(f"\0{param}".encode())
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def materialize(self, key, out_dir):
+        """On a hit, place the cached stems in out_dir and return True."""
+        if not self.enabled:
+            return False
+        entry = self._entry(key)
+        if not all(os.path.exists(os.path.join(entry, name)) for name in STEM_FILES):
+            return False
+        os.makedirs(out_dir, exist_ok=True)
+        for name in STEM_FILES:
+            _link_or_copy(os.path.join(entry, name), os.path.join(out_dir, name))
+        # Entry mtime is the LRU clock.
+        os.utime(entry)
+        return True
+
+    def store(self, key, out_dir):
+        """Add freshly written stems, enforce the size bound, return cache bytes."""
+        if not self.enabled:
+            return 0
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return self.evict()
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.root)
+        try:
+            for name in STEM_FILES:
+                _link_or_copy(os.path.join(out_dir, name), os.path.join(staging, name))
+            os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        return self.evict()
+
+    def evict(self):
+        """Drop least-recently-used entries until the cache fits; return its size."""
+        entries = []
+        total = 0
+        with os.scandir(self.root) as it:
+            for item in it:
+                if not item.is_dir() or item.name.startswith("."):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(item.path, name))
+                    for name in STEM_FILES
+                    if os.path.exists(os.path.join(item.path, name))
+                )
+                entries.append((item.stat().st_mtime, size, item.path))
+                total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logger.info(f"Evicted stem cache entry {os.path.basename(path)}")
+        return total
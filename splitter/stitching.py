@@ -0,0 +1,136 @@
+"""
+Chunk planning and stem stitching for the splitter.
+
+Chunks are cut with an overlap; each separated chunk is faded in/out with a
+linear crossfade over the overlap and added into preallocated output arrays,
+so adjacent chunks sum to unity gain and there is no seam at chunk boundaries.
+
+OverlapAddStitcher fills preallocated arrays for the whole song; the streaming
+pair (iter_overlapping_chunks + StreamingOverlapAddWriter) produces the same
+output while holding only about one chunk plus one overlap in memory.
+"""
+
+import numpy as np
+
+
+def plan_chunks(total_samples, chunk_samples, overlap_samples):
+    """
+    Return [(start, end)] sample spans covering `total_samples`.
+
+    Consecutive spans overlap by exactly `overlap_samples`; every span after the
+    first is longer than the overlap, so crossfades always fit.
+    """
+    if total_samples <= 0:
+        return []
+    overlap_samples = min(overlap_samples, chunk_samples // 2)
+    hop = chunk_samples - overlap_samples
+    spans = []
+    start = 0
+    while True:
+        end = min(start + chunk_samples, total_samples)
+        spans.append((start, end))
+        if end >= total_samples:
+            return spans
+        start += hop
+
+
+def crossfade_weights(length, overlap_samples, fade_in, fade_out):
+    """Per-sample gain for one chunk: linear ramps over the overlapped edges."""
+    weights = np.ones(length, dtype=np.float32)
+    overlap = min(overlap_samples, length)
+    if overlap:
+        ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        if fade_in:
+            weights[:overlap] *= ramp
+        if fade_out:
+            weights[-overlap:] *= ramp[::-1]
+    return weights
+
+
+class OverlapAddStitcher:
+    """Accumulates separated chunks into preallocated (samples, 2) stem arrays."""
+
+    def __init__(self, total_samples, overlap_samples, channels=2):
+        self.total_samples = total_samples
+        self.overlap_samples = overlap_samples
+        self.vocals = np.zeros((total_samples, channels), dtype=np.float32)
+        self.accompaniment = np.zeros((total_samples, channels), dtype=np.float32)
+
+    def add(self, start, vocals, accompaniment):
+        length = min(len(vocals), len(accompaniment), self.total_samples - start)
+        end = start + length
+        weights = crossfade_weights(
+            length,
+            self.overlap_samples,
+            fade_in=start > 0,
+            fade_out=end < self.total_samples,
+        )[:, None]
+        self.vocals[start:end] += vocals[:length] * weights
+        self.accompaniment[start:end] += accompaniment[:length] * weights
+
+
+def iter_overlapping_chunks(blocks, chunk_samples, overlap_samples):
+    """
+    Re-cut a stream of PCM blocks into chunks laid out exactly as plan_chunks()
+    would lay them out, without knowing the total length in advance.
+    """
+    overlap_samples = min(overlap_samples, chunk_samples // 2)
+    hop = chunk_samples - overlap_samples
+    blocks = iter(blocks)
+    buffer = None
+    eof = False
+    while True:
+        # Read one sample past the chunk so we know whether another chunk follows.
+        while not eof and (buffer is None or len(buffer) <= chunk_samples):
+            try:
+                block = next(blocks)
+            except StopIteration:
+                eof = True
+                break
+            buffer = block if buffer is None else np.concatenate([buffer, block])
+        if buffer is None or not len(buffer):
+            return
+        yield buffer[:chunk_samples]
+        if eof and len(buffer) <= chunk_samples:
+            return
+        buffer = buffer[hop:]
+
+
+class StreamingOverlapAddWriter:
+    """
+    Crossfades in-order chunks and appends them to vocals/accompaniment writers.
+
+    Each chunk's last `overlap_samples` are held back until the next chunk
+    arrives (to be crossfaded with its head) or until close(), when they are
+    written unfaded, matching OverlapAddStitcher at the end of the song.
+    """
+
+    def __init__(self, vocals_writer, accompaniment_writer, overlap_samples):
+        self.writers = (vocals_writer, accompaniment_writer)
+        self.overlap_samples = overlap_samples
+        self._tails = None
+
+    def add(self, vocals, accompaniment):
+        length = min(len(vocals), len(accompaniment))
+        stems = (vocals[:length], accompaniment[:length])
+        head = 0
+        if self._tails is not None:
+            head = min(self.overlap_samples, length, len(self._tails[0]))
+            ramp = crossfade_weights(head, head, fade_in=True, fade_out=False)[:, None]
+            for writer, tail, stem in zip(self.writers, self._tails, stems):
+                writer.write(tail[:head] * ramp[::-1] + stem[:head] * ramp)
+        body_end = max(head, length - self.overlap_samples)
+        for writer, stem in zip(self.writers, stems):
+            writer.write(stem[head:body_end])
+        self._tails = tuple(stem[body_end:].copy() for stem in stems)
+
+    def close(self):
+        if self._tails is not None:
+            for writer, tail in zip(self.writers, self._tails):
+                writer.write(tail)
+        for writer in self.writers:
+            writer.close()
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
@@ -0,0 +1,69 @@
+import numpy as np
+from audio_io import SAMPLE_RATE
+from checkpoints import ChunkCheckpoints, separate_resumable
+from silence import SilenceSkipper
+
+
+class EchoSeparator:
+    """Stand-in engine: the input back as accompaniment, no vocals."""
+
+    name = "echo"
+    startup_seconds = 0.0
+
+    def __init__(self):
+        self.seen = 0
+
+    def separate_many(self, waveforms):
+        for waveform in waveforms:
+            self.seen += 1
+            yield np.zeros_like(waveform), waveform, 0.1
+
+
+def silent_chunk(seconds=1):
+    return np.zeros((SAMPLE_RATE * seconds, 2), dtype=np.float32)
+
+
+def loud_chunk(seconds=1):
+    t = np.arange(SAMPLE_RATE * seconds) / SAMPLE_RATE
+    tone = (0.5 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+    return np.stack([tone, tone], axis=1)
+
+
+def test_resumed_silent_chunks_count_as_skipped(tmp_path):
+    chunks = [silent_chunk(), silent_chunk(), loud_chunk()]
+    checkpoints = ChunkCheckpoints("song", 1, root=str(tmp_path))
+    for idx in range(2):
+        checkpoints.save(idx, np.zeros_like(chunks[idx]), chunks[idx])
+
+    engine = EchoSeparator()
+    separator = SilenceSkipper(engine)
+    separator.reset_stats()
+    results = list(
+        separate_resumable(separator, chunks, checkpoints, on_resumed=separator.account)
+    )
+
+    assert [elapsed for _, _, elapsed in results] == [None, None, 0.1]
+    assert engine.seen == 1
+    assert separator.total_samples == 3 * SAMPLE_RATE
+    assert abs(separator.skipped_fraction - 2 / 3) < 1e-9
+
+
+def test_silent_stretch_is_emitted_without_buffering():
+    layout = ["loud"] + ["silent"] * 50 + ["loud", "loud"] + ["silent"] * 5
+    read = []
+
+    def chunks():
+        for kind in layout:
+            read.append(kind)
+            yield loud_chunk() if kind == "loud" else silent_chunk()
+
+    engine = EchoSeparator()
+    separator = SilenceSkipper(engine)
+    emitted = 0
+    for _, accompaniment, elapsed in separator.separate_many(chunks()):
+        assert (elapsed == 0.0) == (layout[emitted] == "silent")
+        assert len(accompaniment) == SAMPLE_RATE
+        emitted += 1
+        assert len(read) - emitted <= 1
+    assert emitted == len(layout)
+    assert engine.seen == 3
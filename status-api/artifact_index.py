@@ -0,0 +1,114 @@
+"""
+In-memory index of the files each pipeline stage has left on disk.
+
+Every tracked directory keeps its last scandir() listing together with the
+directory's mtime; a refresh only re-lists directories whose mtime changed
+(i.e. entries were added, removed or renamed), so the index stays cheap to
+keep current however many songs are on disk. Like git's "racy" index entries,
+a listing taken within `racy_seconds` of the directory's mtime is not trusted:
+on filesystems with coarse timestamps (1 s on many NAS/NFS mounts) an entry
+added in the same tick would not change the mtime, so such directories are
+re-listed until their mtime is safely in the past. Artifacts are keyed by song base
+name ("song" for song.mp3, song.mp3.json, song_karaoke.mp3, stems/song/...).
+Preview tracks (song_preview_karaoke.mp3) only match stages whose suffix is a
+preview suffix, so they never pass for the finished track.
+"""
+
+import os
+import threading
+import time
+
+# Decorations stripped (in order) from an artifact name to get its song base.
+ARTIFACT_SUFFIXES = ("_cover.jpg", ".json", ".mp3", "_karaoke", "_preview")
+PREVIEW_MARK = "_preview_karaoke"
+
+
+def is_preview(name):
+    return PREVIEW_MARK in name
+
+
+def song_base(name):
+    for suffix in ARTIFACT_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+    return name
+
+
+class ArtifactIndex:
+    """
+    `stages` is [(stage, directory, suffix, recursive)]. An empty suffix
+    matches every entry (e.g. the per-song stem directories); recursive stages
+    also index files in subdirectories (the organized artist/album tree).
+    """
+
+    def __init__(self, stages, min_refresh_seconds=2.0, racy_seconds=2.0):
+        self.stages = stages
+        self.min_refresh_seconds = min_refresh_seconds
+        self.racy_ns = int(racy_seconds * 1e9)
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._last_refresh = 0.0
+        # directory -> (mtime_ns, listed_at_ns, [(name, path, is_dir)])
+        self._listings = {}
+        # song base -> {stage: path}
+        self._songs = {}
+
+    def _list_dir(self, directory, seen):
+        """
+        Return the cached listing of `directory`, re-reading it if its mtime
+        changed or the listing was taken too close to that mtime to be trusted.
+        """
+        seen.add(directory)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        cached = self._listings.get(directory)
+        if cached and cached[0] == mtime and cached[1] - mtime >= self.racy_ns:
+            return cached[2]
+        listed_at = time.time_ns()
+        entries = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                # Hidden entries (e.g. the splitter's stems/.cache) are not pipeline files.
+                if not entry.name.startswith("."):
+                    entries.append((entry.name, entry.path, entry.is_dir()))
+        self._listings[directory] = (mtime, listed_at, entries)
+        return entries
+
+    def _scan_stage(self, directory, suffix, recursive, seen, found):
+        for name, path, is_dir in self._list_dir(directory, seen):
+            if is_dir and recursive:
+                self._scan_stage(path, suffix, recursive, seen, found)
+            elif name.endswith(suffix) and is_preview(name) == is_preview(suffix):
+                found[song_base(name)] = path
+
+    def refresh(self, force=False):
+        """Bring the index up to date; rate-limited unless `force` is set."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_refresh < self.min_refresh_seconds:
+                return
+            self._last_refresh = now
+            seen = set()
+            songs = {}
+            for stage, directory, suffix, recursive in self.stages:
+                found = {}
+                self._scan_stage(directory, suffix, recursive, seen, found)
+                for base, path in found.items():
+                    songs.setdefault(base, {})[stage] = path
+            # Forget directories that disappeared (e.g. removed album folders).
+            for directory in set(self._listings) - seen:
+                del self._listings[directory]
+            if songs != self._songs:
+                self._songs = songs
+                self.generation += 1
+
+    def songs(self):
+        """Sorted song base names that have at least one artifact."""
+        self.refresh()
+        return sorted(self._songs)
+
+    def stages_for(self, base):
+        self.refresh()
+        return dict(self._songs.get(base, {}))
@@ -1,13 +1,24 @@
 import os
 import logging
 import time
+import hashlib
 from flask import Flask, jsonify, request, Response
 from shared.pipeline_utils import (
     redis_client,
     get_files_by_status,
-    set_file_status,
+    get_status_counts,
+    get_service_metrics,
+    clear_file_error,
     notify_all,
+    decode_metadata,
+    METADATA_FIELD,
+    LEASE_OWNER_FIELD,
+    get_status_version,
+    get_transition_stats,
+    get_file_records,
+    get_scheduled_queue,
 )
+from artifact_index import ArtifactIndex
 
 # Logging config
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -28,15 +39,6 @@ logger = logging.getLogger(__name__)
 logger.info(f"Logging initialized at {LOG_LEVEL} level")
 
 # Pipeline directories: allow override from env
-PIPELINE_STAGES = [
-    ("input", "INPUT_DIR", ".mp3"),
-    ("queued", "QUEUE_DIR", ".ready"),
-    ("metadata_extracted", "META_DIR", ".json"),
-    ("split", "STEMS_DIR", ""),
-    ("packaged", "OUTPUT_DIR", ".mp3"),
-    ("organized", "ORG_DIR", ".mp3"),
-    ("error", "QUEUE_DIR", ".error"),
-]
 DIRS = {
     stage: os.environ.get(env_key, default_path)
     for (stage, env_key, default_path) in [
@@ -44,43 +46,77 @@ DIRS = {
         ("queued", "QUEUE_DIR", "/queue"),
         ("metadata_extracted", "META_DIR", "/metadata/json"),
         ("split", "STEMS_DIR", "/stems"),
+        ("preview", "OUTPUT_DIR", "/output"),
         ("packaged", "OUTPUT_DIR", "/output"),
         ("organized", "ORG_DIR", "/organized"),
-        ("error", "QUEUE_DIR", "/queue"),
     ]
 }
+# (stage, suffix, recursive): input files may sit in source subdirectories
+# (bot downloads, bulk imports), organized files under artist/album folders.
+PIPELINE_STAGES = [
+    ("input", ".mp3", True),
+    ("queued", ".mp3", False),
+    ("metadata_extracted", ".json", False),
+    ("split", "", False),
+    ("preview", "_preview_karaoke.mp3", False),
+    ("packaged", "_karaoke.mp3", False),
+    ("organized", "_karaoke.mp3", True),
+]
+# Redis statuses reported by /pipeline-health and /metrics.
+PIPELINE_STATUSES = [
+    "queued",
+    "extracting",
+    "metadata_extracted",
+    "splitting",
+    "split",
+    "packaging",
+    "packaged",
+    "organizing",
+    "organized",
+    "retry_scheduled",
+    "error",
+]
+STATUS_INDEX_REFRESH_SECONDS = float(os.environ.get("STATUS_INDEX_REFRESH_SECONDS", 2))
+STATUS_PAGE_SIZE = int(os.environ.get("STATUS_PAGE_SIZE", 100))
+STATUS_MAX_PAGE_SIZE = 1000
 
-
-def list_files(directory, suffix):
-    """List files in directory with optional suffix filtering."""
-    if not os.path.exists(directory):
-        return []
-    if suffix:
-        return [f for f in os.listdir(directory) if f.endswith(suffix)]
-    else:
-        return os.listdir(directory)
+artifact_index = ArtifactIndex(
+    [(stage, DIRS[stage], suffix, recursive) for stage, suffix, recursive in PIPELINE_STAGES],
+    min_refresh_seconds=STATUS_INDEX_REFRESH_SECONDS,
+)
 
 
-def get_file_status(filename):
-    """Return status and last error for the given file from Redis and file system."""
-    stages = {}
-    namebase = os.path.splitext(filename)[0]
-    for stage, dirkey, suffix in PIPELINE_STAGES:
-        dirpath = DIRS[stage]
-        for f in list_files(dirpath, suffix):
-            if namebase in f:
-                stages[stage] = os.path.join(dirpath, f)
-    redis_data = redis_client.hgetall(f"file:{filename}")
-    status = redis_data.get("status", "unknown")
-    last_error = redis_data.get("error", "")
+def file_status_entry(filename, redis_data):
     return {
         "filename": filename,
-        "stages": stages,
-        "status": status,
-        "last_error": last_error,
+        "stages": artifact_index.stages_for(os.path.splitext(filename)[0]),
+        "status": redis_data.get("status", "unknown"),
+        "last_error": redis_data.get("error", ""),
+        "metadata": decode_metadata(redis_data.get(METADATA_FIELD)),
+        "lease_owner": redis_data.get(LEASE_OWNER_FIELD),
     }
 
 
+def get_file_statuses(filenames):
+    """Status entries for many files with one pipelined Redis round trip."""
+    return [
+        file_status_entry(filename, data)
+        for filename, data in zip(filenames, get_file_records(filenames))
+    ]
+
+
+def get_file_status(filename):
+    """Return status, last error and metadata for the given file from Redis and file system."""
+    return get_file_statuses([filename])[0]
+
+
+def page_args():
+    """(offset, limit) from the query string; raises ValueError on bad input."""
+    offset = max(int(request.args.get("offset", 0)), 0)
+    limit = min(max(int(request.args.get("limit", STATUS_PAGE_SIZE)), 1), STATUS_MAX_PAGE_SIZE)
+    return offset, limit
+
+
 app = Flask(__name__)
 
 
@@ -92,18 +128,48 @@ def health():
 
 @app.route("/status")
 def status():
-    all_bases = set()
-    for stage, dirkey, suf in PIPELINE_STAGES:
-        for f in list_files(DIRS[stage], suf):
-            all_bases.add(os.path.splitext(f)[0])
-    file_statuses = [get_file_status(f"{b}.mp3") for b in all_bases]
-    return jsonify({"files": file_statuses})
+    """
+    Paginated file statuses, served from the artifact index.
+
+    Query params: status (comma-separated Redis statuses), offset, limit.
+    Supports If-None-Match: the ETag only changes when a status transition
+    happened or the files on disk changed.
+    """
+    statuses = [s for s in request.args.get("status", "").split(",") if s]
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+
+    artifact_index.refresh()
+    etag = hashlib.sha1(
+        f"{artifact_index.generation}:{get_status_version()}:{','.join(statuses)}:"
+        f"{offset}:{limit}".encode()
+    ).hexdigest()
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    if statuses:
+        # The status index is authoritative, including files already cleaned from disk.
+        filenames = sorted({f for s in statuses for f in get_files_by_status(s)})
+    else:
+        filenames = [f"{base}.mp3" for base in artifact_index.songs()]
+    page = filenames[offset:offset + limit]
+    response = jsonify(
+        {
+            "files": get_file_statuses(page),
+            "total": len(filenames),
+            "offset": offset,
+            "limit": limit,
+        }
+    )
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/error-files")
 def error_files():
-    error_files = get_files_by_status("error")
-    details = [get_file_status(f) for f in error_files]
+    details = get_file_statuses(get_files_by_status("error"))
     return jsonify({"error_files": details})
 
 
@@ -116,19 +182,39 @@ def retry_file():
     filekey = f"file:{filename}"
     if not redis_client.exists(filekey):
         return jsonify({"error": "File not found"}), 404
-    set_file_status(filename, "queued")
-    for stage in ["metadata", "splitter", "packager", "organizer"]:
-        redis_client.delete(f"{stage}_retries:{filename}")
-    redis_client.hdel(filekey, "error")
+    clear_file_error(filename)
     notify_all("File Retry Triggered", f"🔄 File {filename} reset to queued and retries cleared.")
     return jsonify({"message": f"File {filename} reset to queued and retries cleared."})
 
 
 @app.route("/pipeline-health")
 def pipeline_health():
-    stages = ["queued", "metadata_extracted", "split", "packaged", "organized", "error"]
-    counts = {stage: len(get_files_by_status(stage)) for stage in stages}
-    return jsonify(counts)
+    return jsonify(get_status_counts(PIPELINE_STATUSES))
+
+
+@app.route("/queue")
+def splitter_queue():
+    """
+    The splitter's pending work in the order it will be taken (priority
+    class, shortest first, aged by waiting time), with each job's effective
+    (aged) priority class.
+    Query params: offset, limit.
+    """
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    jobs = get_scheduled_queue("metadata_extracted")
+    for position, job in enumerate(jobs, 1):
+        job["position"] = position
+    return jsonify(
+        {
+            "jobs": jobs[offset:offset + limit],
+            "total": len(jobs),
+            "offset": offset,
+            "limit": limit,
+        }
+    )
 
 
 @app.route("/error-details/<filename>")
@@ -141,18 +227,59 @@ def error_details(filename):
 
 
 start_time = time.time()
+METRIC_SERVICES = ["watcher", "metadata", "splitter", "packager", "organizer"]
+
+
+def metric_type(name):
+    return "counter" if name.endswith(("_total", "_sum")) else "gauge"
+
+
+def render_family(lines, name, mtype, samples):
+    """Append one metric family: its # TYPE line, then `samples` [(labels, value)]."""
+    lines.append(f"# TYPE {name} {mtype}")
+    for labels, value in samples:
+        lines.append(f"{name}{labels} {value}")
+
+
+def render_histogram(lines, name, per_status):
+    lines.append(f"# TYPE {name} histogram")
+    for status, hist in per_status.items():
+        for le, count in hist["buckets"]:
+            lines.append(f'{name}_bucket{{status="{status}",le="{le}"}} {count}')
+        lines.append(f'{name}_sum{{status="{status}"}} {hist["sum"]}')
+        lines.append(f'{name}_count{{status="{status}"}} {hist["count"]}')
 
 
 @app.route("/metrics")
 def metrics():
-    stages = ["queued", "metadata_extracted", "split", "packaged", "organized", "error"]
     metrics_lines = []
-    for stage in stages:
-        count = len(get_files_by_status(stage))
-        metrics_lines.append(f"karaoke_files_{stage} {count}")
+    for stage, count in get_status_counts(PIPELINE_STATUSES).items():
+        render_family(metrics_lines, f"karaoke_files_{stage}", "gauge", [("", count)])
+
+    transitions, histograms = get_transition_stats()
+    render_family(
+        metrics_lines,
+        "karaoke_status_transitions_total",
+        "counter",
+        [
+            (f'{{from="{prev}",to="{status}"}}', count)
+            for (prev, status), count in sorted(transitions.items())
+        ],
+    )
+    for name, per_status in histograms.items():
+        render_histogram(metrics_lines, f"karaoke_{name}", per_status)
+
+    for service, values in get_service_metrics(METRIC_SERVICES).items():
+        # Group labelled fields (name{...}) under one family per metric name.
+        families = {}
+        for field, value in sorted(values.items()):
+            name, brace, labels = field.partition("{")
+            families.setdefault(name, []).append((brace + labels, value))
+        for name, samples in families.items():
+            render_family(metrics_lines, f"karaoke_{service}_{name}", metric_type(name), samples)
     uptime = int(time.time() - start_time)
-    metrics_lines.append(f"karaoke_statusapi_uptime_seconds {uptime}")
-    return Response("\n".join(metrics_lines), mimetype="text/plain")
+    render_family(metrics_lines, "karaoke_statusapi_uptime_seconds", "gauge", [("", uptime)])
+    return Response("\n".join(metrics_lines) + "\n", mimetype="text/plain")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,35 @@
+import pytest
+
+from shared import pipeline_utils
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+import status_api  # noqa: E402
+
+SCRIPTS = ("_set_status_script", "_merge_metadata_script")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Flask test client over an in-memory Redis."""
+    redis = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(pipeline_utils, "redis_client", redis)
+    monkeypatch.setattr(status_api, "redis_client", redis)
+    for name in SCRIPTS:
+        monkeypatch.setattr(getattr(pipeline_utils, name), "registered_client", redis)
+    return status_api.app.test_client()
+
+
+def test_status_etag_changes_when_bot_metadata_is_merged(client):
+    pipeline_utils.set_file_metadata("song.mp3", {"TIT2": "track01", "TPE1": "Unknown Artist"})
+    url = "/status?status=metadata_extracted"
+    etag = client.get(url).headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    pipeline_utils.merge_file_metadata("song.mp3", {"TIT2": "Real Title", "TPE1": "Real Artist"})
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["files"][0]["metadata"]["TIT2"] == "Real Title"
@@ -13,6 +13,7 @@ from telegram.ext import (
 )
 import yt_dlp
 import musicbrainzngs
+from shared.pipeline_utils import clean_string, merge_file_metadata
 
 # Log level via env
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -32,6 +33,9 @@ logging.info(f"Logging initialized at {LOG_LEVEL} level")
 
 # Directories and env config
 INPUT_DIR = os.environ.get("INPUT_DIR", "/input")
+# Downloads land in their own input subdirectory, which the watcher tags as
+# bot requests so the splitter serves them ahead of bulk imports.
+BOT_INPUT_DIR = os.path.join(INPUT_DIR, os.environ.get("BOT_INPUT_SUBDIR", "telegram"))
 META_DIR = os.environ.get("META_DIR", "/metadata/json")
 TELEGRAM_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
 YTDLP_COOKIES = os.environ.get("YT_DLP_COOKIES_FILE", "/cookies/cookies.txt")
@@ -42,7 +46,8 @@ AWAITING_METADATA = 1
 # Helper: Download YouTube audio (with cookies if present)
 
 
-def download_youtube_audio(url, output_dir=INPUT_DIR):
+def download_youtube_audio(url, output_dir=BOT_INPUT_DIR):
+    os.makedirs(output_dir, exist_ok=True)
     ydl_opts = {
         "format": "bestaudio/best",
         "outtmpl": os.path.join(output_dir, "%(title)s.%(ext)s"),
@@ -232,6 +237,11 @@ async def receive_metadata(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     save_metadata_json(base, metadata)
+    # By now the extractor has usually stored the file's own tags in Redis;
+    # the choice made here replaces them (the sidecar covers the other case).
+    await asyncio.get_event_loop().run_in_executor(
+        None, merge_file_metadata, clean_string(f"{base}.mp3"), metadata
+    )
     await update.message.reply_text(
         f"Metadata saved!\n\nTitle: {metadata['TIT2']}\nArtist: {metadata['TPE1']}\nAlbum: {metadata['TALB']}\n\nReady for pipeline processing."
     )
@@ -1,6 +1,6 @@
 import time
 import os
-import shutil
+import functools
 import logging
 import threading
 from flask import Flask
@@ -8,10 +8,22 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from shared.pipeline_utils import (
     set_file_status,
-    get_files_by_status,
+    get_file_records,
+    RETRY_STATUS,
     set_file_error,
     notify_all,
     clean_string,
+    set_metric,
+    incr_metric,
+    setup_transfer_strategy,
+    transfer_file,
+    input_source,
+    source_fields,
+    PREVIEW_CYCLE_FIELDS,
+    worker_monitor,
+    start_worker,
+    health_response,
+    metrics_response,
 )
 import traceback
 import datetime
@@ -37,56 +49,185 @@ logger.info(f"Logging initialized at {LOG_LEVEL} level")
 INPUT_DIR = os.environ.get("INPUT_DIR", "/input")
 QUEUE_DIR = os.environ.get("QUEUE_DIR", "/queue")
 STABILITY_CHECKS = int(os.environ.get("FILE_STABILITY_CHECKS", 4))
+STABILITY_INTERVAL = float(os.environ.get("FILE_STABILITY_INTERVAL", 2))
+# A file in one of these is still going through the pipeline; events on its
+# input (a touch, a rename) must not pull it back to "queued" mid-job.
+ACTIVE_STATUSES = {
+    "queued",
+    "extracting",
+    "metadata_extracted",
+    "splitting",
+    "split",
+    "packaging",
+    "packaged",
+    "organizing",
+    RETRY_STATUS,
+}
+# "<size>:<mtime_ns>" of the input as it was queued, to tell a changed file
+# from the same content seen again.
+INPUT_STAT_FIELD = "input_stat"
 
 
-class MP3Handler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory or not event.src_path.endswith(".mp3"):
-            return
-        fname = os.path.basename(event.src_path)
-        fname = clean_string(fname)
-        if fname in get_files_by_status("error"):
+def input_signature(path):
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def enqueue_file(src_path, strategy="copy"):
+    """Transfer a stable input file into the queue and mark it queued.
+
+    The file's source (bot, bulk import or plain drop, from its INPUT_DIR
+    subdirectory) is recorded with it and sets the splitter priority class.
+    A re-dropped file starts over: any preview-cycle fields (preview marker,
+    priority override) left from its last run are dropped. Files still in the
+    pipeline, and finished ones whose input has not changed since they were
+    queued, are left alone.
+    """
+    fname = clean_string(os.path.basename(src_path))
+    try:
+        record = get_file_records([fname])[0]
+        status = record.get("status")
+        if status == "error":
             logger.warning(f"File {fname} is in error state, skipping.")
             return
-        try:
-            stable_count = 0
-            while True:
-                if not os.path.exists(event.src_path):
-                    return
-                initial_size = os.path.getsize(event.src_path)
-                initial_mtime = os.path.getmtime(event.src_path)
-                time.sleep(2)
-                if not os.path.exists(event.src_path):
-                    return
-                current_size = os.path.getsize(event.src_path)
-                current_mtime = os.path.getmtime(event.src_path)
-                if initial_size == current_size and initial_mtime == current_mtime:
-                    stable_count += 1
+        if status in ACTIVE_STATUSES:
+            logger.info(f"File {fname} is already {status}, not re-queuing.")
+            return
+        signature = input_signature(src_path)
+        if record.get(INPUT_STAT_FIELD) == signature:
+            logger.info(f"File {fname} is unchanged since it was queued, skipping.")
+            return
+        dest = os.path.join(QUEUE_DIR, fname)
+        used = transfer_file(src_path, dest, strategy)
+        incr_metric("watcher", f'transfers_total{{strategy="{used}"}}')
+        source = input_source(src_path)
+        set_file_status(
+            fname,
+            "queued",
+            extra={**source_fields(source), INPUT_STAT_FIELD: signature},
+            remove_fields=PREVIEW_CYCLE_FIELDS,
+        )
+        logger.info(f"Queued {fname} from {source} and set Redis status to 'queued'")
+    except Exception as e:
+        tb = traceback.format_exc()
+        timestamp = datetime.datetime.now().isoformat()
+        error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
+        set_file_error(fname, error_details)
+        notify_all(
+            "Karaoke Pipeline Error",
+            f"Error in watcher for {fname} at {timestamp}:\n{e}",
+        )
+
+
+class StabilityTracker:
+    """
+    Central registry of files that are still being written.
+
+    Observer events only record candidates; a single timer thread checks the
+    size/mtime of every candidate each STABILITY_INTERVAL seconds and hands a
+    file to `on_stable` as soon as it has been unchanged for STABILITY_CHECKS
+    consecutive checks, independently of every other file. A close-after-write
+    event (inotify IN_CLOSE_WRITE) shortcuts this to a single confirming check.
+    """
+
+    def __init__(self, on_stable, checks=STABILITY_CHECKS, interval=STABILITY_INTERVAL):
+        self.on_stable = on_stable
+        self.checks = checks
+        self.interval = interval
+        self._candidates = {}
+        self._lock = threading.Lock()
+
+    def track(self, path):
+        """Start (or restart) watching a file that was created or modified."""
+        with self._lock:
+            self._candidates[path] = [None, None, 0]
+
+    def mark_closed(self, path):
+        """The writer closed the file; enqueue after one unchanged check."""
+        with self._lock:
+            entry = self._candidates.setdefault(path, [None, None, 0])
+            entry[2] = max(entry[2], self.checks - 1)
+
+    def pending(self):
+        with self._lock:
+            return len(self._candidates)
+
+    def poll(self):
+        """Check every candidate once; return the paths that became stable."""
+        stable = []
+        with self._lock:
+            for path, entry in list(self._candidates.items()):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    del self._candidates[path]
+                    continue
+                if (st.st_size, st.st_mtime) == (entry[0], entry[1]):
+                    entry[2] += 1
                 else:
-                    stable_count = 0
-                if stable_count >= STABILITY_CHECKS:
-                    break
-            dest = os.path.join(QUEUE_DIR, fname)
-            shutil.copy2(event.src_path, dest)
-            set_file_status(fname, "queued")
-            logger.info(f"Queued {fname} and set Redis status to 'queued'")
-        except Exception as e:
-            tb = traceback.format_exc()
-            timestamp = datetime.datetime.now().isoformat()
-            error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
-            set_file_error(fname, error_details)
-            notify_all(
-                "Karaoke Pipeline Error",
-                f"Error in watcher for {fname} at {timestamp}:\n{e}",
-            )
+                    # First sighting keeps a close-write head start; a real
+                    # change restarts the count.
+                    entry[2] = entry[2] if entry[0] is None else 0
+                    entry[0], entry[1] = st.st_size, st.st_mtime
+                if entry[2] >= self.checks:
+                    del self._candidates[path]
+                    stable.append(path)
+        return stable
+
+    def run(self):
+        last_pending = None
+        while True:
+            worker_monitor.beat()
+            for path in self.poll():
+                with worker_monitor.job():
+                    self.on_stable(path)
+            pending = self.pending()
+            if pending != last_pending:
+                set_metric("watcher", "pending_files", pending)
+                last_pending = pending
+            time.sleep(self.interval)
+
+
+def is_mp3_event(event, path):
+    return not event.is_directory and path.endswith(".mp3")
+
+
+class MP3Handler(FileSystemEventHandler):
+    def __init__(self, tracker):
+        super().__init__()
+        self.tracker = tracker
+
+    def on_created(self, event):
+        if is_mp3_event(event, event.src_path):
+            self.tracker.track(event.src_path)
+
+    def on_modified(self, event):
+        if is_mp3_event(event, event.src_path):
+            self.tracker.track(event.src_path)
+
+    def on_moved(self, event):
+        if is_mp3_event(event, event.dest_path):
+            self.tracker.track(event.dest_path)
+
+    def on_closed(self, event):
+        if is_mp3_event(event, event.src_path):
+            self.tracker.mark_closed(event.src_path)
 
 
 def run_watcher():
     os.makedirs(QUEUE_DIR, exist_ok=True)
-    event_handler = MP3Handler()
+    strategy = setup_transfer_strategy("watcher", INPUT_DIR, QUEUE_DIR)
+    tracker = StabilityTracker(
+        on_stable=functools.partial(enqueue_file, strategy=strategy)
+    )
+    tracker_thread = threading.Thread(target=tracker.run, daemon=True, name="stability-tracker")
+    worker_monitor.watch(tracker_thread)
+    tracker_thread.start()
+    event_handler = MP3Handler(tracker)
     observer = Observer()
     observer.schedule(event_handler, INPUT_DIR, recursive=True)
     observer.start()
+    worker_monitor.watch(observer)
     logger.info("Watcher started.")
     try:
         while True:
@@ -101,10 +242,14 @@ app = Flask(__name__)
 
 @app.route("/health")
 def health():
-    return "ok", 200
+    return health_response()
+
+
+@app.route("/metrics")
+def metrics():
+    return metrics_response()
 
 
 if __name__ == "__main__":
-    t = threading.Thread(target=run_watcher, daemon=True)
-    t.start()
+    start_worker("watcher", run_watcher)
     app.run(host="0.0.0.0", port=5000)